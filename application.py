@@ -1,22 +1,37 @@
 # application.py
 
+import time
+# when this process started loading the server, so we can report how long startup took
+BOOT_STARTED = time.time()
+
 import logging
+import os
+import signal
 
 import tornado.autoreload
 import tornado.escape
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 from tornado.options import define, options
 import tornado.httpserver
 
+import src.aswwu.alchemy as alchemy
 import src.aswwu.base_handlers as base
+import src.aswwu.caching as caching
+import src.aswwu.name_index as name_index
+import src.aswwu.photo_map as photo_map
+import src.aswwu.revocations as revocations
 import src.aswwu.route_handlers.ask_anything as ask_anything
 import src.aswwu.route_handlers.elections as elections
 import src.aswwu.route_handlers.forms as forms
 import src.aswwu.route_handlers.instagram as instagram
 import src.aswwu.route_handlers.mask as mask
+import src.aswwu.route_handlers.profile_views as profile_views
 import src.aswwu.route_handlers.saml as saml
 import src.aswwu.route_handlers.volunteers as volunteers
+import src.aswwu.view_tracker as view_tracker
 # import our super secret keys
 from settings import keys
 
@@ -27,6 +42,11 @@ from settings import keys
 define("port", default=8888, help="run on the given port", type=int)
 define("log_name", default="aswwu", help="name of the logfile")
 define("current_year", default="1718")
+# production mode: `python server.py --production --processes=0`
+define("production", default=False, help="run pre-forked worker processes without autoreload")
+define("processes", default=0, help="number of worker processes in production mode, 0 for one per CPU")
+define("reuse_port", default=False, help="give each worker its own SO_REUSEPORT socket instead of sharing one")
+define("drain_timeout", default=10, help="seconds a worker waits for open requests to finish after SIGTERM")
 
 
 # the main class that wraps everything up nice and neat
@@ -35,17 +55,23 @@ class Application(tornado.web.Application):
     handlers = [
             (r"/login", base.BaseLoginHandler),
             (r"/profile/(.*)/(.*)", mask.ProfileHandler),
+            (r"/profiles/batch", mask.ProfileBatchHandler),
             (r"/profile_photo/(.*)/(.*)", mask.ProfilePhotoHandler),
+            (r"/profile_photos", mask.ProfilePhotosHandler),
             (r"/role/administrator", mask.AdministratorRoleHandler),
             (r"/role/volunteer", volunteers.VolunteerRoleHandler),
             (r"/search/all", mask.SearchAllHandler),
+            (r"/search/all-years/(.*)", mask.AllYearsSearchHandler),
             (r"/search/(.*)/(.*)", mask.SearchHandler),
             (r"/update/(.*)", mask.ProfileUpdateHandler),
+            (r"/views/top", profile_views.TopViewedHandler),
+            (r"/views/trend/(.*)", profile_views.ViewTrendHandler),
             (r"/volunteer", volunteers.VolunteerHandler),
             (r"/volunteer/(.*)", volunteers.VolunteerHandler),
             (r"/feed", instagram.FeedHandler),
             (r"/verify", base.BaseVerifyLoginHandler),
             (r"/", base.BaseIndexHandler),
+            (r"/cache/stats", base.ResponseCacheStatsHandler),
             (r"/senate_election/showall", elections.AllElectionVoteHandler),
             (r"/senate_election/vote/(.*)", elections.ElectionVoteHandler),
             (r"/senate_election/livefeed", elections.ElectionLiveFeedHandler),
@@ -85,7 +111,10 @@ class Application(tornado.web.Application):
         fh.setFormatter(formatter)
         logger.addHandler(fh)
         tornado.web.Application.__init__(self, self.handlers, **settings)
-        logger.info("Application started on port " + str(options.port))
+        # nothing cached by an earlier Application in this process is known to still be current
+        caching.clear_responses()
+        logger.info("Application started on port " + str(options.port) + " in " +
+                    str(int((time.time() - BOOT_STARTED) * 1000)) + "ms")
 
 def start_server(tornado, io_loop):
     # create a new instance of our Application
@@ -96,10 +125,74 @@ def start_server(tornado, io_loop):
     server.listen(options.port)
     # tell it to autoreload if anything changes
     tornado.autoreload.start()
+    io_loop.add_callback(name_index.start)
+    io_loop.add_callback(photo_map.start)
+    io_loop.add_callback(view_tracker.start)
+    io_loop.add_callback(revocations.start)
     io_loop.start()
+    # write out the views counted since the last flush
+    view_tracker.stop()
     print 'tornado server started'
 
 def stop_server(io_loop):
     io_loop.add_callback(io_loop.stop)
     server.stop()
     print 'tornado server stopped'
+
+
+# binds the port once and forks worker processes that all accept on it
+# the parent restarts any worker that dies and passes SIGTERM on to all of them
+# it starts a new process group for that, so stop it with SIGTERM rather than ctrl+c
+def start_production_server():
+    os.setpgrp()
+    sockets = None
+    if not options.reuse_port:
+        sockets = tornado.netutil.bind_sockets(options.port)
+    parent_pid = os.getpid()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_workers(parent_pid))
+    # only the workers ever return from this, the parent stays inside watching them
+    tornado.process.fork_processes(options.processes)
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(options.port, reuse_port=True)
+    # connections opened before the fork belong to the parent
+    alchemy.dispose_engines()
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    global application
+    application = Application()
+    global server
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    signal.signal(signal.SIGTERM, lambda signum, frame: io_loop.add_callback_from_signal(drain_server, io_loop))
+    io_loop.add_callback(name_index.start)
+    io_loop.add_callback(photo_map.start)
+    io_loop.add_callback(view_tracker.start)
+    io_loop.add_callback(revocations.start)
+    io_loop.start()
+    # already drained, another SIGTERM shouldn't cut the exit short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    view_tracker.stop()
+    logging.getLogger(options.log_name).info("worker " + str(tornado.process.task_id()) + " stopped")
+
+
+def stop_workers(parent_pid):
+    if os.getpid() != parent_pid:
+        # a worker that hasn't set up its own handler yet
+        os._exit(0)
+    # the parent is in the same process group, so it has to ignore the signal it's about to send
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.killpg(os.getpgrp(), signal.SIGTERM)
+
+
+# stop accepting connections, then give the open requests up to drain_timeout seconds to finish
+# workers exit normally afterwards, so the parent doesn't restart them
+def drain_server(io_loop):
+    server.stop()
+    deadline = time.time() + options.drain_timeout
+
+    def stop_when_idle():
+        if base.active_requests == 0 or time.time() > deadline:
+            io_loop.stop()
+        else:
+            io_loop.add_timeout(time.time() + 0.1, stop_when_idle)
+    stop_when_idle()
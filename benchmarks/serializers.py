@@ -0,0 +1,100 @@
+# serializers.py
+
+# compares the old to_json (working out the columns and what to skip on every call) with the serializers
+# the models now build once and keep (see bases.serializer) over the profile listings we send the most of
+# both have to give exactly the same output, the benchmark stops if they don't
+# run from the project root: `python benchmarks/serializers.py --rows=10000`
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import tornado.options  # noqa: E402
+from tornado.options import define, options  # noqa: E402
+
+import src.aswwu.archive_models as archives  # noqa: E402
+import src.aswwu.models.bases as bases  # noqa: E402
+import src.aswwu.models.mask as mask_model  # noqa: E402
+
+define("rows", default=10000, help="number of profiles serialized per benchmark")
+define("rounds", default=3, help="times each benchmark is run, the best one counts")
+
+
+# what Base.to_json did before it was compiled
+def reflective_to_json(thing, **kwargs):
+    obj = {}
+    columns = [str(key).split(".")[1] for key in thing.__table__.columns]
+    skip_list = ['id'] + kwargs.get('skip_list', [])
+    limit_list = kwargs.get('limitList', columns)
+    for key in limit_list:
+        if key not in skip_list and key != "views":
+            obj[key] = bases.json_value(key, getattr(thing, key))
+        elif key == "views":
+            obj[key] = str(thing.num_views())
+    return obj
+
+
+# what ArchiveBase.to_json did before it was compiled
+def reflective_archive_to_json(thing, **kwargs):
+    obj = {}
+    columns = [str(key).split(".")[1] for key in thing.__table__.columns]
+    skip_list = ['id'] + kwargs.get('skip_list', [])
+    limit_list = kwargs.get('limitList', columns)
+    for key in limit_list:
+        if key not in skip_list:
+            value = getattr(thing, key)
+            try:
+                obj[key] = str(value)
+            except:
+                pass
+    return obj
+
+
+def make_profile(model, i, **kwargs):
+    return model(id=i, wwuid=str(900000 + i), username=u"first.last" + str(i),
+                 full_name=u"First Last\u00e9 " + str(i), photo=u"profiles/1718/" + str(i) + ".jpg",
+                 email=u"first.last" + str(i) + "@wallawalla.edu", gender=u"Female", birthday=u"01-01",
+                 majors=u"Computer Science", minors=u"Math", class_standing=u"Senior", class_of=u"2018",
+                 hobbies=u"reading, hiking", quote=u"\u201cquotes\u201d", privacy=1, **kwargs)
+
+
+def best_time(fn, rows):
+    best = None
+    for _ in range(options.rounds):
+        start = time.time()
+        for row in rows:
+            fn(row)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    tornado.options.parse_command_line()
+    profiles = [make_profile(mask_model.Profile, i, view_count=i % 100) for i in xrange(options.rows)]
+    archive_model = archives.get_archive_model(archives.ARCHIVE_YEARS[-1])
+    archived = [make_profile(archive_model, i, views=i % 100) for i in xrange(options.rows)]
+    benchmarks = [
+        ("base_info", profiles, mask_model.Profile.BASE_INFO_FIELDS, reflective_to_json),
+        ("view_other", profiles, mask_model.Profile.VIEW_OTHER_FIELDS, reflective_to_json),
+        ("info", profiles, None, reflective_to_json),
+        ("archive view_other", archived, mask_model.Profile.VIEW_OTHER_FIELDS, reflective_archive_to_json),
+        ("archive info", archived, None, reflective_archive_to_json),
+    ]
+    print str(options.rows) + " rows, best of " + str(options.rounds)
+    for name, rows, fields, reflective in benchmarks:
+        kwargs = {} if fields is None else {'limitList': fields}
+        for row in rows:
+            if reflective(row, **kwargs) != row.to_json(**kwargs):
+                print name + ": outputs differ for " + row.username
+                sys.exit(1)
+        before = best_time(lambda row: reflective(row, **kwargs), rows)
+        after = best_time(lambda row: row.to_json(**kwargs), rows)
+        print "{:<20} reflective {:>7.3f}s   compiled {:>7.3f}s   {:>5.1f}x".format(name, before, after,
+                                                                                   before / after)
+
+
+if __name__ == "__main__":
+    main()
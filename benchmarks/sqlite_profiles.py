@@ -0,0 +1,103 @@
+# sqlite_profiles.py
+
+# compares SQLite profiles (see sqlite_profiles in default.conf) on the writes we do the most of:
+# profile views (look up the viewer/viewed pair, then insert or bump it) and senate election votes
+# every write is its own commit, just like alchemy.add_or_update, while a second thread keeps reading
+# run from the project root: `python benchmarks/sqlite_profiles.py --writes=2000`
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine, event  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+import tornado.options  # noqa: E402
+from tornado.options import define, options  # noqa: E402
+
+import src.aswwu.alchemy as alchemy  # noqa: E402
+import src.aswwu.models.mask as mask_model  # noqa: E402
+import src.aswwu.models.elections as election_model  # noqa: E402
+
+define("writes", default=1000, help="number of committed writes per benchmark")
+
+PROFILES = [
+    ("sqlite defaults", {}),
+    ("wal", {"journal_mode": "WAL"}),
+    ("wal, synchronous=normal", {"journal_mode": "WAL", "synchronous": "NORMAL"}),
+    ("configured (people)", None),
+]
+
+
+def make_engine(path, profile):
+    new_engine = create_engine("sqlite:///" + path, connect_args={'check_same_thread': False})
+    event.listen(new_engine, "connect",
+                 lambda dbapi_connection, connection_record: alchemy.apply_sqlite_profile(dbapi_connection, profile))
+    return new_engine
+
+
+# keeps reading until told to stop, counting how many reads made it through
+def reader(new_engine, table, stop, counts):
+    connection = new_engine.connect()
+    while not stop.is_set():
+        connection.execute("SELECT count(*) FROM " + table).scalar()
+        counts.append(1)
+    connection.close()
+
+
+def profile_view_writes(session, writes):
+    for i in xrange(writes):
+        viewer, viewed = "viewer." + str(i % 50), "viewed." + str(i % 200)
+        view = session.query(mask_model.ProfileView).filter_by(viewer=viewer, viewed=viewed).first()
+        if view is None:
+            view = mask_model.ProfileView(viewer=viewer, viewed=viewed, num_views=0)
+        view.num_views += 1
+        view.last_viewed = datetime.datetime.now()
+        session.add(view)
+        session.commit()
+
+
+def election_votes(session, writes):
+    for i in xrange(writes):
+        session.add(election_model.Election(wwuid=str(9000000 + i), candidate_one="a", candidate_two="b"))
+        session.commit()
+
+
+def run(name, metadata, table, workload, profile, writes):
+    directory = tempfile.mkdtemp()
+    try:
+        new_engine = make_engine(os.path.join(directory, "bench.db"), profile)
+        metadata.create_all(new_engine)
+        session = sessionmaker(bind=new_engine)()
+        stop, counts = threading.Event(), []
+        thread = threading.Thread(target=reader, args=(new_engine, table, stop, counts))
+        thread.start()
+        start = time.time()
+        workload(session, writes)
+        elapsed = time.time() - start
+        stop.set()
+        thread.join()
+        session.close()
+        new_engine.dispose()
+        print "  {:<28} {:>9.0f} writes/s {:>9.0f} concurrent reads/s".format(
+            name, writes / elapsed, len(counts) / elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    tornado.options.parse_command_line()
+    tornado.options.parse_config_file("src/aswwu/default.conf")
+    for label, metadata, table, workload in [
+            ("profile views", mask_model.Base.metadata, "profileviews", profile_view_writes),
+            ("election votes", election_model.ElectionBase.metadata, "elections", election_votes)]:
+        print label + " (" + str(options.writes) + " writes)"
+        for name, profile in PROFILES:
+            if profile is None:
+                profile = alchemy.sqlite_profile("people")
+            run(name, metadata, table, workload, profile, options.writes)
@@ -0,0 +1,195 @@
+# migrate.py
+
+# creates any tables, columns and indexes that are missing from our databases, then ANALYZEs them
+# and builds the full text search indexes
+# run it on a fresh checkout and whenever the models change: `python migrate.py`
+# `python migrate.py --rebuild_view_counts` recounts every profile's views from the profileviews table
+# `python migrate.py --explain` prints the query plan of each of the lookups in alchemy.py
+# `python migrate.py --vacuum` VACUUMs every database first, the search indexes are rebuilt afterwards as always
+# (always VACUUM through here, see search_index.py)
+# (the server doesn't do this itself anymore, so starting it stays fast)
+
+import tornado.options
+from sqlalchemy import MetaData, event, func, inspect, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+from tornado.options import define, options
+
+# imported for the options it defines (sqlite_profiles etc.)
+import application  # pylint: disable=W0611
+import src.aswwu.alchemy as alchemy
+import src.aswwu.archive_models as archives
+import src.aswwu.models.ask_anything as ask_anything_model
+import src.aswwu.models.elections as election_model
+import src.aswwu.models.forms as forms_model
+import src.aswwu.models.mask as mask_model
+import src.aswwu.models.pages as pages_model
+import src.aswwu.models.volunteers as volunteer_model
+import src.aswwu.search_index as search_index
+
+define("rebuild_view_counts", default=False, help="recount Profile.view_count from the profileviews table")
+define("explain", default=False, help="print the query plans of the alchemy.py lookups after migrating")
+define("vacuum", default=False, help="VACUUM every database before rebuilding the search indexes")
+
+# the models that live in each database
+# each model module has its own declarative base, mask's comes first since the others point at its users table
+SCHEMAS = [
+    ('people', [mask_model.Base.metadata, volunteer_model.Base.metadata, ask_anything_model.Base.metadata]),
+    ('senate_elections', [election_model.ElectionBase.metadata]),
+    ('pages', [pages_model.PagesBase.metadata]),
+    ('jobs', [forms_model.JobsBase.metadata]),
+]
+
+
+# all of a database's tables in one MetaData, so foreign keys between model modules can be resolved
+def database_metadata(metadatas):
+    combined = MetaData()
+    for metadata in metadatas:
+        for table in metadata.tables.values():
+            table.tometadata(combined)
+    return combined
+
+
+def create_schema():
+    added = []
+    for name, metadatas in SCHEMAS:
+        print 'creating missing tables in ' + name
+        metadata = database_metadata(metadatas)
+        metadata.create_all(alchemy.get_engine(name))
+        added += add_missing_columns(alchemy.get_engine(name), metadata)
+        add_missing_indexes(alchemy.get_engine(name), metadata)
+        # so SQLite's planner knows which of those indexes are worth using
+        alchemy.get_engine(name).execute("ANALYZE")
+    # a brand new view_count column starts out at 0 for everyone
+    if options.rebuild_view_counts or ('profiles', 'view_count') in added:
+        rebuild_view_counts()
+
+
+# create_all only creates whole tables, so new columns on existing tables get added here
+# returns the (table, column) names it added
+def add_missing_columns(engine, metadata):
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    added = []
+    for table in metadata.tables.values():
+        if table.name not in tables:
+            continue
+        existing = [column['name'] for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in existing:
+                print 'adding ' + table.name + '.' + column.name
+                engine.execute("ALTER TABLE " + table.name + " ADD COLUMN " +
+                               str(CreateColumn(column).compile(dialect=engine.dialect)))
+                added.append((table.name, column.name))
+    return added
+
+
+# the same for indexes declared on the models (index=True or __table_args__), matched by name
+def add_missing_indexes(engine, metadata):
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    for table in metadata.tables.values():
+        if table.name not in tables:
+            continue
+        existing = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                print 'adding index ' + index.name
+                index.create(engine)
+
+
+# sets every profile's view_count to the total of its rows in profileviews
+def rebuild_view_counts():
+    print 'recounting profile views'
+    profiles = mask_model.Profile.__table__
+    views = mask_model.ProfileView.__table__
+    total = select([func.coalesce(func.sum(views.c.num_views), 0)]).where(views.c.viewed == profiles.c.username)
+    with alchemy.get_engine('people').begin() as connection:
+        connection.execute(profiles.update().values(view_count=total.as_scalar()))
+
+
+# rewrites each database file without its free pages
+# this can renumber the rowids the search indexes point at, so create_search_indexes() has to run after it
+def vacuum_databases():
+    names = [name for name, metadatas in SCHEMAS]
+    if alchemy.database_exists('archives'):
+        names.append('archives')
+    for name in names:
+        print 'vacuuming ' + name
+        alchemy.get_engine(name).execute("VACUUM")
+
+
+# (re)builds the search indexes, the current year's is kept up to date by triggers from then on
+def create_search_indexes():
+    print 'building search index for ' + mask_model.Profile.__tablename__
+    with alchemy.get_engine('people').begin() as connection:
+        search_index.create_index(connection, mask_model.Profile.__tablename__)
+    # archives.db isn't part of a fresh checkout, and the server only ever opens it read only
+    if not alchemy.database_exists('archives'):
+        print 'no archives database, skipping the archive search indexes'
+        return
+    engine = alchemy.get_engine('archives')
+    tables = inspect(engine).get_table_names()
+    with engine.begin() as connection:
+        for year in archives.ARCHIVE_YEARS:
+            model = archives.get_archive_model(year)
+            if model.__tablename__ in tables:
+                print 'building search index for ' + model.__tablename__
+                search_index.create_index(connection, model.__tablename__, triggers=False)
+
+
+# the lookups in alchemy.py, each with some arguments to run it with
+EXPLAINED_QUERIES = [
+    ('query_all(Profile)', alchemy.query_all, [mask_model.Profile]),
+    ('query_by_wwuid(Profile)', alchemy.query_by_wwuid, [mask_model.Profile, '0']),
+    ('query_by_id(Profile)', alchemy.query_by_id, [mask_model.Profile, '0']),
+    ('query_by_field(Profile, username)', alchemy.query_by_field, [mask_model.Profile, 'username', 'x']),
+    ('query_user', alchemy.query_user, ['0']),
+    ('query_identity', alchemy.query_identity, ['0']),
+    ('query_table_versions', alchemy.query_table_versions, [['profiles']]),
+    ('query_by_wwuid(Volunteer)', alchemy.query_by_wwuid, [volunteer_model.Volunteer, '0']),
+    ('query_all_election(Election)', alchemy.query_all_election, [election_model.Election]),
+    ('query_by_wwuid_election(Election)', alchemy.query_by_wwuid_election, [election_model.Election, '0']),
+    ('query_by_page_url(Page)', alchemy.query_by_page_url, [pages_model.Page, 'x']),
+    ('query_by_page_id(Page)', alchemy.query_by_page_id, [pages_model.Page, '0']),
+    ('query_by_job_name(JobForm)', alchemy.query_by_job_name, [forms_model.JobForm, 'x']),
+    ('query_all_forms(JobForm)', alchemy.query_all_forms, [forms_model.JobForm]),
+]
+
+
+# runs each lookup, catching the SQL it sends, and prints SQLite's plan for every statement
+# a SCAN of a table means it's read from start to finish
+def explain_queries():
+    statements = []
+
+    def catch(conn, cursor, statement, parameters, context, executemany):
+        statements.append((cursor.connection, statement, parameters))
+
+    event.listen(Engine, "before_cursor_execute", catch)
+    try:
+        for label, helper, args in EXPLAINED_QUERIES:
+            del statements[:]
+            helper(*args)
+            print label
+            for connection, statement, parameters in statements:
+                print '  ' + ' '.join(statement.split())[:100]
+                for row in connection.execute("EXPLAIN QUERY PLAN " + statement, parameters):
+                    print '    ' + row[-1]
+            alchemy.remove_sessions()
+    finally:
+        event.remove(Engine, "before_cursor_execute", catch)
+
+
+if __name__ == "__main__":
+    config = tornado.options.parse_command_line()
+    if len(config) == 0:
+        conf_name = "default"
+    else:
+        conf_name = config[0]
+    tornado.options.parse_config_file("src/aswwu/" + conf_name + ".conf")
+    create_schema()
+    if options.vacuum:
+        vacuum_databases()
+    create_search_indexes()
+    if options.explain:
+        explain_queries()
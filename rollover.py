@@ -0,0 +1,88 @@
+# rollover.py
+
+# copies last year's archived profiles into this year's Profile table ahead of time
+# so nobody has to wait for it on their first request of the year
+# run it once current_year has been bumped in the conf: `python rollover.py` or `python rollover.py --chunk_size=1000`
+# it's safe to stop and run again, anyone who already has a profile is skipped
+import time
+
+import tornado.options
+from tornado.options import define, options
+
+# imported for the options it defines (current_year etc.)
+import application  # pylint: disable=W0611
+import src.aswwu.alchemy as alchemy
+import src.aswwu.archive_models as archives
+import src.aswwu.models.mask as mask_model
+from src.aswwu.base_handlers import get_last_year, import_profile
+
+define("chunk_size", default=500, help="number of archived profiles copied per transaction")
+
+
+# walk the archive table in id order, one chunk at a time, so memory doesn't grow with the table
+def archive_chunks(model, chunk_size):
+    last_id = None
+    while True:
+        query = alchemy.archive_db.query(model).order_by(model.id)
+        if last_id is not None:
+            query = query.filter(model.id > last_id)
+        chunk = query.limit(chunk_size).all()
+        if not chunk:
+            return
+        last_id = chunk[-1].id
+        yield chunk
+        alchemy.archive_db.expunge_all()
+
+
+# creates profiles for everyone in the chunk that has an account but no profile yet
+# returns (copied, skipped)
+def copy_chunk(chunk):
+    wwuids = [str(old_profile.wwuid) for old_profile in chunk]
+    users = dict((user.wwuid, user) for user in alchemy.people_db.query(mask_model.User)
+                 .filter(mask_model.User.wwuid.in_(wwuids)))
+    existing = set(row.wwuid for row in alchemy.people_db.query(mask_model.Profile.wwuid)
+                   .filter(mask_model.Profile.wwuid.in_(wwuids)))
+    copied = 0
+    for old_profile in chunk:
+        wwuid = str(old_profile.wwuid)
+        if wwuid in existing or wwuid not in users:
+            continue
+        user = users[wwuid]
+        new_profile = mask_model.Profile(wwuid=wwuid, username=user.username, full_name=user.full_name)
+        import_profile(new_profile, old_profile.export_info())
+        alchemy.people_db.add(new_profile)
+        existing.add(wwuid)
+        copied += 1
+    try:
+        alchemy.people_db.commit()
+    except Exception:
+        alchemy.people_db.rollback()
+        raise
+    alchemy.people_db.expunge_all()
+    return copied, len(chunk) - copied
+
+
+def rollover(chunk_size):
+    model = archives.get_archive_model(get_last_year())
+    total = alchemy.archive_db.query(model).count()
+    done = copied = skipped = 0
+    start = time.time()
+    print 'copying ' + str(total) + ' profiles from ' + model.__tablename__
+    for chunk in archive_chunks(model, chunk_size):
+        chunk_copied, chunk_skipped = copy_chunk(chunk)
+        copied += chunk_copied
+        skipped += chunk_skipped
+        done += len(chunk)
+        print '{}/{} ({:.0%}) copied: {} skipped: {} last id: {} elapsed: {:.1f}s'.format(
+            done, total, float(done) / total, copied, skipped, chunk[-1].id, time.time() - start)
+    print 'done, copied ' + str(copied) + ' profiles'
+
+
+if __name__ == "__main__":
+    config = tornado.options.parse_command_line()
+    if len(config) == 0:
+        conf_name = "default"
+    else:
+        conf_name = config[0]
+    tornado.options.parse_config_file("src/aswwu/" + conf_name + ".conf")
+    rollover(options.chunk_size)
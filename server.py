@@ -2,7 +2,7 @@
 import threading
 
 import tornado.ioloop
-from tornado.options import define
+from tornado.options import define, options
 
 import application
 
@@ -18,9 +18,16 @@ if __name__ == "__main__":
     else:
         conf_name = config[0]
 
+    tornado.options.parse_config_file("src/aswwu/"+conf_name+".conf")
+
+    # production runs pre-forked workers on one port until it gets SIGTERM
+    # e.g. `python server.py --production --processes=4`
+    if options.production:
+        application.start_production_server()
+        exit(0)
+
     # initiate the IO loop for Tornado
     io_loop = tornado.ioloop.IOLoop(make_current=False).instance()
-    tornado.options.parse_config_file("src/aswwu/"+conf_name+".conf")
 
     # create thread for running the server
     thread = threading.Thread(target=application.start_server, args=(tornado, io_loop))
@@ -34,4 +41,7 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print 'stopping services...'
         application.stop_server(io_loop)
+        # the server thread still writes out pending profile views once its IOLoop stops (see view_tracker)
+        # and as a daemon thread it would be killed if we exited first
+        thread.join()
         exit(0)
@@ -10,4 +10,9 @@ testing = {
 DATABASE = {
     # Location of database relative to project directory.
     'location': '/databases',
+    # Connection pool settings for each database (e.g. 'people', 'jobs').
+    # Anything not listed for a database comes from 'default'.
+    'pool': {
+        'default': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30},
+    },
 }
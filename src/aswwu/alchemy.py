@@ -2,241 +2,522 @@
 
 # import and set up the logging
 import logging
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, joinedload
-import src.aswwu.models.bases as base
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+from sqlalchemy import create_engine, event, inspect, literal_column, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, sessionmaker, scoped_session, joinedload, lazyload
+from sqlalchemy.pool import QueuePool
+import src.aswwu.caching as caching
 import src.aswwu.models.mask as mask_model
-from src.aswwu.archive_models import ArchiveBase
 from settings import DATABASE
-
-Base = base.Base
-ElectionBase = base.ElectionBase
-PagesBase = base.PagesBase
-JobsBase = base.JobsBase
+from src.aswwu.models.bases import uuid_gen
+from tornado.options import define, options
 
 logger = logging.getLogger("aswwu")
 
 # import the necessary models (all of them in this case)
 
-# defines the databases URLs relative to "server.py"
-# ?check_same_thread=False should only be a temp fix
-engine = create_engine(  # pylint: disable=C0103
-    "sqlite://" + DATABASE['location'] + "/people.db?check_same_thread=False")
-archive_engine = create_engine(  # pylint: disable=C0103
-    "sqlite://" +
-    DATABASE['location'] + "/archives.db?check_same_thread=False")
-election_engine = create_engine(  # pylint: disable=C0103
-    "sqlite://" +
-    DATABASE['location'] + "/senate_elections.db?check_same_thread=False")
-pages_engine = create_engine(  # pylint: disable=C0103
-    "sqlite://" + DATABASE['location'] + "/pages.db?check_same_thread=False")
-jobs_engine = create_engine(  # pylint: disable=C0103
-    "sqlite://" + DATABASE['location'] + "/jobs.db?check_same_thread=False")
-
-# create the model tables if they don't already exist
-Base.metadata.create_all(engine)
-ElectionBase.metadata.create_all(election_engine)
-PagesBase.metadata.create_all(pages_engine)
-JobsBase.metadata.create_all(jobs_engine)
+# SQLite settings run as PRAGMAs on every new connection
+# keyed by database name (e.g. "people", "jobs"), anything not set for a database comes from "default"
+define("sqlite_profiles", default={
+    "default": {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000, "cache_size": -8000,
+                "temp_store": "MEMORY", "mmap_size": 67108864},
+}, help="SQLite PRAGMAs to run on each new connection, by database name")
+
+# the PRAGMAs a profile may set, in the order they're run
+# busy_timeout goes first so switching journal modes waits on other connections instead of failing
+SQLITE_PRAGMAS = ['busy_timeout', 'journal_mode', 'synchronous', 'cache_size', 'temp_store', 'mmap_size']
+
+
+# the profile for one database, with the defaults filled in
+def sqlite_profile(name):
+    profile = dict(options.sqlite_profiles.get('default', {}))
+    profile.update(options.sqlite_profiles.get(name, {}))
+    return profile
+
+
+# read only connections skip journal_mode, that's a change to the file itself
+def apply_sqlite_profile(dbapi_connection, profile, readonly=False):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        if pragma in profile and not (readonly and pragma == 'journal_mode'):
+            value = str(profile[pragma])
+            # these go straight into the SQL, so only allow plain numbers and words
+            if not re.match(r"^-?\w+$", value):
+                raise ValueError("bad value for PRAGMA " + pragma + ": " + value)
+            cursor.execute("PRAGMA " + pragma + "=" + value)
+    cursor.close()
+
+
+# opens a connection to a database file
+# read only connections use SQLite's mode=ro, plus immutable=1 for files nothing ever writes to
+# python 2's sqlite3 can't open URIs, so there we fall back on PRAGMA query_only
+# connections are handed from thread to thread by the pool (never shared at the same time),
+# hence check_same_thread=False
+def connect(path, readonly=False, immutable=False):
+    if readonly and sys.version_info >= (3, 4):
+        uri = "file:" + path + "?mode=ro" + ("&immutable=1" if immutable else "")
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    if readonly:
+        connection.execute("PRAGMA query_only=1")
+    return connection
+
+
+def database_url(name):
+    return "sqlite://" + DATABASE['location'] + "/" + name + ".db"
+
+
+# the file behind one of our databases, e.g. "databases/people.db" for "people" (relative to "server.py")
+# opening a database that doesn't exist creates an empty one, so check this first if it might be missing
+def database_path(name):
+    return make_url(database_url(name)).database
+
+
+def database_exists(name):
+    return os.path.exists(database_path(name))
+
+
+# creates the engine for one of our databases, e.g. "people" for people.db
+# each engine keeps its own pool of connections, sized by DATABASE['pool'] in settings.py
+# every new connection gets that database's SQLite profile (see sqlite_profiles above)
+def make_engine(name, readonly=False, immutable=False):
+    pool = dict(DATABASE['pool']['default'])
+    pool.update(DATABASE['pool'].get(name, {}))
+    url = database_url(name)
+    path = database_path(name)
+    new_engine = create_engine(url, creator=lambda: connect(path, readonly, immutable), poolclass=QueuePool, **pool)
+    event.listen(new_engine, "connect",
+                 lambda dbapi_connection, connection_record: apply_sqlite_profile(dbapi_connection,
+                                                                                  sqlite_profile(name), readonly))
+    return new_engine
+
+
+# databases nothing writes to while the server is running, their read only engines open them immutable
+IMMUTABLE_DATABASES = ['archives']
+
+# engines are only created the first time they're used, keyed by (name, readonly)
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(name, readonly=False):
+    key = (name, readonly)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = make_engine(name, readonly, immutable=readonly and name in IMMUTABLE_DATABASES)
+    return _engines[key]
+
+
+# a session that sends its reads to the database's read only engine, so they never wait on a writer's lock
+# as soon as it has something to write, everything goes to the read-write engine
+# until the next commit or rollback, that way a request always sees its own changes
+# sessions for databases that are never written to (writable=False) always use the read only engine
+class RoutingSession(Session):
+    def __init__(self, database=None, writable=True, **kwargs):
+        Session.__init__(self, **kwargs)
+        self.database = database
+        self.writable = writable
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.writable and (self._flushing or self.info.get('written') or self.new or self.dirty or self.deleted):
+            return get_engine(self.database)
+        return get_engine(self.database, readonly=True)
+
+    # Core statements that write have to ask for the read-write engine themselves, e.g.
+    # `session.execute(table.insert(), rows, bind=session.write_bind())` (with a scoped session, call it first)
+    # everything after it in the same transaction goes there too, so it sees what was written
+    def write_bind(self):
+        self.info['written'] = True
+        return get_engine(self.database)
+
+
+# a tag for responses that only depend on who has which photo, e.g. the photo redirects
+# profiles gets written every few seconds just to count views, so they'd hardly ever be cached with that
+PHOTOS_TAG = 'profile_photos'
+# the same for profiles' names, e.g. the name index (see name_index.py)
+NAMES_TAG = 'profile_names'
+# tag -> the profile columns it depends on
+PROFILE_TAGS = {PHOTOS_TAG: ['wwuid', 'username', 'photo'], NAMES_TAG: ['username', 'full_name']}
+
+
+# the tables a flush writes to, plus the PROFILE_TAGS of the profiles it creates, deletes or changes them in
+def _written_tables(session):
+    tables = set()
+    for thing in list(session.new) + list(session.dirty) + list(session.deleted):
+        tables.add(getattr(thing, '__tablename__', None))
+        if isinstance(thing, mask_model.Profile):
+            for tag, columns in PROFILE_TAGS.items():
+                if thing not in session.dirty or any(inspect(thing).attrs[column].history.has_changes()
+                                                     for column in columns):
+                    tables.add(tag)
+    return tables
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _mark_written(session, flush_context):
+    session.info['written'] = True
+    # remembered until the commit, see _invalidate_responses()
+    session.info.setdefault('tables', set()).update(_written_tables(session))
+
+
+@event.listens_for(RoutingSession, "after_commit")
+@event.listens_for(RoutingSession, "after_rollback")
+def _clear_written(session):
+    session.info.pop('written', None)
+
+
+# cached responses are tagged with the tables they're built from (see caching.cached_response)
+# so every commit, whether through add_or_update, delete_thing and friends or not, throws away the ones it changes
+@event.listens_for(RoutingSession, "after_commit")
+def _invalidate_responses(session):
+    tables = session.info.pop('tables', None)
+    if tables:
+        caching.invalidate_tags(tables)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_tables(session):
+    session.info.pop('tables', None)
+
+
+# tables (and tags) whose row in tableversions goes up with every flush that writes to them
+# (through add_or_update, delete_thing or any other commit), see query_table_versions()
+VERSIONED_TABLES = ['profiles', 'users', PHOTOS_TAG, NAMES_TAG]
+
+
+# bumped in the same transaction as the write itself
+@event.listens_for(RoutingSession, "before_flush")
+def _bump_table_versions(session, flush_context, instances):
+    versions = mask_model.TableVersion.__table__
+    for name in sorted(_written_tables(session).intersection(VERSIONED_TABLES)):
+        bind = session.write_bind()
+        session.execute(versions.insert().prefix_with("OR IGNORE").values(id=uuid_gen(), name=name, version=0),
+                        bind=bind)
+        session.execute(versions.update().where(versions.c.name == name).values(version=versions.c.version + 1),
+                        bind=bind)
+
 
 # bind instances of the databases to corresponding variables
-Base.metadata.bind = engine
-dbs = sessionmaker(bind=engine)
-people_db = dbs()
+# these are scoped sessions: each thread gets its own session, opened the first time it's used
+# they're for the database threads (see async_alchemy) and other background work, which close them when done
+# request handlers share the IOLoop thread, so they use their own sessions instead (see RequestSessions)
+# tables are created by `python migrate.py`, not here
+dbs = sessionmaker(class_=RoutingSession, database="people")
+people_db = scoped_session(dbs)
 # same for archives
-ArchiveBase.metadata.bind = archive_engine
-archive_dbs = sessionmaker(bind=archive_engine)
-archive_db = archive_dbs()
+archive_dbs = sessionmaker(class_=RoutingSession, database="archives", writable=False)
+archive_db = scoped_session(archive_dbs)
 # same for elections
-ElectionBase.metadata.bind = election_engine
-election_dbs = sessionmaker(bind=election_engine)
-election_db = election_dbs()
+election_dbs = sessionmaker(class_=RoutingSession, database="senate_elections")
+election_db = scoped_session(election_dbs)
 # same for pages
-PagesBase.metadata.bind = election_engine
-pages_dbs = sessionmaker(bind=pages_engine)
-page_db = pages_dbs()
+pages_dbs = sessionmaker(class_=RoutingSession, database="pages")
+page_db = scoped_session(pages_dbs)
+
+jobs_dbs = sessionmaker(class_=RoutingSession, database="jobs")
+jobs_db = scoped_session(jobs_dbs)
+
 
-JobsBase.metadata.bind = election_engine
-jobs_dbs = sessionmaker(bind=jobs_engine)
-jobs_db = jobs_dbs()
+# one request's sessions, each opened the first time it's asked for and all closed together
+# BaseHandler opens these in prepare() and closes them in on_finish(), handlers pass them to the helpers below
+# e.g. `alchemy.add_or_update(thing, self.people_db)`
+class RequestSessions:
+    def __init__(self):
+        self.sessions = {}
+
+    # factory is one of the sessionmakers above, e.g. alchemy.dbs
+    def get(self, factory):
+        if factory not in self.sessions:
+            self.sessions[factory] = factory()
+        return self.sessions[factory]
+
+    # rolls back anything that wasn't committed and hands the connections back to their pools
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+
+
+# throws away every pooled connection, e.g. in a freshly forked worker
+def dispose_engines():
+    with _engines_lock:
+        for each_engine in _engines.values():
+            each_engine.dispose()
+
+
+# closes this thread's sessions, rolling back anything that wasn't committed
+# and handing the connections back to their pools
+def remove_sessions():
+    for session in (people_db, archive_db, election_db, page_db, jobs_db):
+        session.remove()
 
 
 # updates a model, or creates it if it doesn't exist
-def add_or_update(thing):
+def add_or_update(thing, db=None):
+    if db is None:
+        db = people_db
     try:
-        people_db.add(thing)
-        people_db.commit()
+        db.add(thing)
+        db.commit()
         return thing
     except Exception as e:
         logger.info(e)
-        people_db.rollback()
+        db.rollback()
 
 
 # finds all rows for a given model
-def query_all(model):
+def query_all(model, db=None):
+    if db is None:
+        db = people_db
     thing = None
     try:
-        thing = people_db.query(model).all()
+        thing = db.query(model).all()
     except Exception as e:
         logger.info(e)
-        people_db.rollback()
+        db.rollback()
     return thing
 
 
+# reads all rows for a given model a batch at a time, in rowid order (the same order query_all gives)
+# relationships aren't loaded, so only use it when they aren't needed
+# returns (rows, rowid to pass back as `after` for the next batch or None after the last one)
+# errors are raised rather than returning nothing, an empty batch would look like the end of the data
+def query_batch(db, model, after, size):
+    try:
+        rowid = literal_column(model.__tablename__ + ".rowid")
+        query = db.query(model, rowid.label('rowid')).options(lazyload('*')).order_by(rowid)
+        if after is not None:
+            query = query.filter(rowid > after)
+        rows = query.limit(size).all()
+        return [row[0] for row in rows], rows[-1][1] if len(rows) == size else None
+    except Exception as e:
+        logger.info(e)
+        db.rollback()
+        raise
+
+
 # finds all rows for a given model matching the given WWUID
-def query_by_wwuid(model, wwuid):
+def query_by_wwuid(model, wwuid, db=None):
+    if db is None:
+        db = people_db
     thing = None
     try:
-        thing = people_db.query(model).filter_by(wwuid=str(wwuid)).all()
+        thing = db.query(model).filter_by(wwuid=str(wwuid)).all()
     except Exception as e:
         logger.info(e)
-        people_db.rollback()
+        db.rollback()
     return thing
 
 
 # finds all rows for a given model matching the given ID
-def query_by_id(model, aid):
+def query_by_id(model, aid, db=None):
+    if db is None:
+        db = people_db
     thing = None
     try:
-        thing = people_db.query(model).filter_by(id=aid).first()
+        thing = db.query(model).filter_by(id=aid).first()
     except Exception as e:
         logger.info(e)
-        people_db.rollback()
+        db.rollback()
     return thing
 
 
 # finds all rows for a given model matching the given field=value
-def query_by_field(model, field, value):
+def query_by_field(model, field, value, db=None):
+    if db is None:
+        db = people_db
     thing = None
     try:
-        thing = people_db.query(model).filter(getattr(model, field).like(value)).all()
+        thing = db.query(model).filter(getattr(model, field).like(value)).all()
     except Exception as e:
         logger.info(e)
-        people_db.rollback()
+        db.rollback()
     return thing
 
 
 # finds a user with the given WWUID
-def query_user(wwuid):
-    thing = query_by_wwuid(mask_model.User, str(wwuid))
+def query_user(wwuid, db=None):
+    thing = query_by_wwuid(mask_model.User, str(wwuid), db)
     if thing:
         thing = thing[0]
     return thing
 
 
+# finds what a logged in user needs from both the User and Profile tables in one query
+# only these columns are loaded, so the profile's views never get pulled in
+# profile_id is None if they don't have a profile yet
+def query_identity(wwuid, db=None):
+    if db is None:
+        db = people_db
+    thing = None
+    try:
+        thing = db.query(mask_model.User.username, mask_model.User.roles, mask_model.User.status,
+                         mask_model.User.full_name.label('user_full_name'),
+                         mask_model.Profile.id.label('profile_id'), mask_model.Profile.full_name,
+                         mask_model.Profile.photo)\
+            .outerjoin(mask_model.Profile, mask_model.Profile.wwuid == mask_model.User.wwuid)\
+            .filter(mask_model.User.wwuid == str(wwuid)).first()
+    except Exception as e:
+        logger.info(e)
+        db.rollback()
+    return thing
+
+
+# the current versions of the given tables as a tuple, e.g. (3, 12) for ['profiles', 'users']
+# None if they can't be looked up (e.g. migrate.py hasn't created tableversions yet)
+def query_table_versions(names, db=None):
+    if db is None:
+        db = people_db
+    thing = None
+    try:
+        versions = mask_model.TableVersion.__table__
+        found = dict(db.execute(select([versions.c.name, versions.c.version])
+                                .where(versions.c.name.in_(names))).fetchall())
+        thing = tuple(found.get(name, 0) for name in names)
+    except Exception as e:
+        logger.info(e)
+        db.rollback()
+    return thing
+
+
 # permanently deletes a given model
-def delete_thing(thing):
+def delete_thing(thing, db=None):
+    if db is None:
+        db = people_db
     try:
-        people_db.delete(thing)
-        people_db.commit()
+        db.delete(thing)
+        db.commit()
     except Exception as e:
         logger.info(e)
-        people_db.rollback()
+        db.rollback()
 
 
-def query_all_election(model):
-    return query_all_by_db(election_db, model)
+def query_all_election(model, db=None):
+    return query_all_by_db(election_db if db is None else db, model)
 
 
 def query_all_by_db(db, model):
     thing = None
     try:
-        thing = election_db.query(model).all()
+        thing = db.query(model).all()
     except Exception as e:
         logger.info(e)
-        election_db.rollback()
+        db.rollback()
     return thing
 
 
-def add_or_update_election(thing):
+def add_or_update_election(thing, db=None):
+    if db is None:
+        db = election_db
     try:
-        election_db.add(thing)
-        election_db.commit()
+        db.add(thing)
+        db.commit()
         return thing
     except Exception as e:
         logger.info(e)
-        election_db.rollback()
+        db.rollback()
 
 
 # finds all rows for a given model matching the given WWUID
-def query_by_wwuid_election(model, wwuid):
+def query_by_wwuid_election(model, wwuid, db=None):
+    if db is None:
+        db = election_db
     thing = None
     try:
-        thing = election_db.query(model).filter_by(wwuid=str(wwuid)).all()
+        thing = db.query(model).filter_by(wwuid=str(wwuid)).all()
     except Exception as e:
         logger.info(e)
-        election_db.rollback()
+        db.rollback()
     return thing
 
 
 # updates a model, or creates it if it doesn't exist
-def add_or_update_page(thing):
+def add_or_update_page(thing, db=None):
+    if db is None:
+        db = page_db
     try:
-        page_db.add(thing)
-        page_db.commit()
+        db.add(thing)
+        db.commit()
         return thing
     except Exception as e:
         logger.info(e)
-        page_db.rollback()
+        db.rollback()
 
 
-def query_by_page_url(model, url):
+def query_by_page_url(model, url, db=None):
+    if db is None:
+        db = page_db
     thing = None
     try:
-        thing = page_db.query(model).options(joinedload('*')).filter_by(url=str(url)).all()
+        thing = db.query(model).options(joinedload('*')).filter_by(url=str(url)).all()
     except Exception as e:
         logger.info(e)
-        page_db.rollback()
+        db.rollback()
     return thing
 
 
-def query_by_page_id(model, page_id):
+def query_by_page_id(model, page_id, db=None):
+    if db is None:
+        db = page_db
     thing = None
     try:
-        thing = page_db.query(model).options(joinedload('*')).filter_by(id=str(page_id)).all()
+        thing = db.query(model).options(joinedload('*')).filter_by(id=str(page_id)).all()
     except Exception as e:
         logger.info(e)
-        page_db.rollback()
+        db.rollback()
     return thing
 
 
 # updates a model, or creates it if it doesn't exist
-def add_or_update_form(thing):
+def add_or_update_form(thing, db=None):
+    if db is None:
+        db = jobs_db
     try:
-        jobs_db.add(thing)
-        jobs_db.commit()
+        db.add(thing)
+        db.commit()
         return thing
     except Exception as e:
         logger.info(e)
-        jobs_db.rollback()
+        db.rollback()
 
 
-def query_by_job_name(model, name):
+def query_by_job_name(model, name, db=None):
+    if db is None:
+        db = jobs_db
     thing = None
     try:
-        thing = jobs_db.query(model).options(joinedload('*')).filter_by(job_name=str(name)).all()
+        thing = db.query(model).options(joinedload('*')).filter_by(job_name=str(name)).all()
     except Exception as e:
         logger.info(e)
-        jobs_db.rollback()
+        db.rollback()
     return thing
 
 
-def query_all_forms(model):
+def query_all_forms(model, db=None):
+    if db is None:
+        db = jobs_db
     thing = None
     try:
-        thing = jobs_db.query(model).all()
+        thing = db.query(model).all()
     except Exception as e:
         logger.info(e)
-        jobs_db.rollback()
+        db.rollback()
     return thing
 
 
 # permanently deletes a given model
-def delete_thing_forms(thing):
+def delete_thing_forms(thing, db=None):
+    if db is None:
+        db = jobs_db
     try:
-        jobs_db.delete(thing)
-        jobs_db.commit()
+        db.delete(thing)
+        db.commit()
     except Exception as e:
         logger.info(e)
-        jobs_db.rollback()
+        db.rollback()
@@ -2,39 +2,42 @@
 
 # this file defines individual models for each of the previous years
 # at this point the fields have all been standardized
-# each year just add another model class and add the year's shorthand (i.e. 1415) to the array at the bottom
+# each year just add the year's shorthand (i.e. 1415) to ARCHIVE_YEARS at the bottom
+
+import threading
 
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 
+from src.aswwu.models.bases import serializer, STR
+
 
 # define a base model for the Archives
 class ArchiveBase(object):
     # a useful function is being able to call `model.to_json()` and getting valid JSON to send to the user
+    # if called with `model.to_json(skip_list=["something"])` then "something" will be skipped
+    # if called with `model.to_json(limitList=["something"])` then only those columns will even be checked
+    # by default we check all of the table's columns
+    # values are str()'d, anything that can't be is left out (see bases.serializer)
     def to_json(self, **kwargs):
+        return serializer(type(self), kwargs.get('limitList'), kwargs.get('skip_list', []), STR)(self)
+
+    # the same as to_json(limitList=keys) for a row of columns picked out by a query (see Query.with_entities)
+    @classmethod
+    def row_to_json(cls, row, keys):
         obj = {}
-        # get the column names of the table
-        columns = [str(key).split(".")[1] for key in self.__table__.columns]
-        # if called with `model.to_json(skipList=["something"])`
-        # then "something" will be added to the list of columns to skip
-        skip_list = ['id'] + kwargs.get('skip_list', [])
-        # if called similarly to skipList, then only those columns will even be checked
-        # by default we check all of the table's columns
-        limit_list = kwargs.get('limitList', columns)
-        for key in limit_list:
-            if key not in skip_list:
-                # fancy way of saying "self.key"
-                value = getattr(self, key)
-                # try to set the value as a string, but that doesn't always work
-                # NOTE: this should be encoded more properly sometime
+        for key in keys:
+            if key != 'id':
                 try:
-                    obj[key] = str(value)
+                    obj[key] = str(getattr(row, key))
                 except:
                     pass
         return obj
 
+    BASE_INFO_FIELDS = ['username', 'full_name', 'photo', 'email', 'views']
+
     def base_info(self):
-        return self.to_json(limitList=['username', 'full_name', 'photo', 'email', 'views'])
+        return self.to_json(limitList=self.BASE_INFO_FIELDS)
     # TODO: remove email from base_info
 
     def no_info(self):
@@ -66,101 +69,64 @@ class ArchiveBase(object):
 ArchiveBase = declarative_base(cls=ArchiveBase)
 
 
-def set_archive_columns(self):
-    self.wwuid = Column(Integer, nullable=False)
-    self.username = Column(String(250))
-    self.full_name = Column(String(250))
-    self.photo = Column(String(250))
-    self.gender = Column(String(250))
-    self.birthday = Column(String(250))
-    self.email = Column(String(250))
-    self.phone = Column(String(250))
-    self.website = Column(String(250))
-    self.majors = Column(String(500))
-    self.minors = Column(String(500))
-    self.graduate = Column(String(250))
-    self.preprofessional = Column(String(250))
-    self.class_standing = Column(String(250))
-    self.high_school = Column(String(250))
-    self.class_of = Column(String(250))
-    self.relationship_status = Column(String(250))
-    self.attached_to = Column(String(250))
-    self.quote = Column(String(1000))
-    self.quote_author = Column(String(250))
-    self.hobbies = Column(String(500))
-    self.career_goals = Column(String(1000))
-    self.favorite_books = Column(String(1000))
-    self.favorite_food = Column(String(1000))
-    self.favorite_movies = Column(String(1000))
-    self.favorite_music = Column(String(1000))
-    self.pet_peeves = Column(String(500))
-    self.personality = Column(String(250))
-    self.views = Column(Integer)
-    self.privacy = Column(Integer)
-    self.department = Column(String(250))
-    self.office = Column(String(250))
-    self.office_hours = Column(String(250))
-
-
-class Archive1617(ArchiveBase):
-    __tablename__ = 'profiles1617'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive1516(ArchiveBase):
-    __tablename__ = 'profiles1516'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive1415(ArchiveBase):
-    __tablename__ = 'profiles1415'
-    id = Column(String(50), primary_key=True)
-
-
-# FIXME: Projects here and after cannot have a blank query(return internal server error instead of a list of all profiles);
-class Archive1314(ArchiveBase):
-    __tablename__ = 'profiles1314'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive1213(ArchiveBase):
-    __tablename__ = 'profiles1213'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive1112(ArchiveBase):
-    __tablename__ = 'profiles1112'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive1011(ArchiveBase):
-    __tablename__ = 'profiles1011'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive0910(ArchiveBase):
-    __tablename__ = 'profiles0910'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive0809(ArchiveBase):
-    __tablename__ = 'profiles0809'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive0708(ArchiveBase):
-    __tablename__ = 'profiles0708'
-    id = Column(String(50), primary_key=True)
-
-
-class Archive0607(ArchiveBase):
-    __tablename__ = 'profiles0607'
-    id = Column(String(50), primary_key=True)
-
-
+# the years we have archives for, newest first
+# each year's profiles live in archives.db in a table named e.g. profiles1617
+# FIXME: 1314 and older cannot have a blank query (return internal server error instead of a list of all profiles);
+ARCHIVE_YEARS = ["1617", "1516", "1415", "1314", "1213", "1112", "1011", "0910", "0809", "0708", "0607"]
+
+
+def archive_columns():
+    return {
+        'id': Column(String(50), primary_key=True),
+        'wwuid': Column(Integer, nullable=False),
+        'username': Column(String(250)),
+        'full_name': Column(String(250)),
+        'photo': Column(String(250)),
+        'gender': Column(String(250)),
+        'birthday': Column(String(250)),
+        'email': Column(String(250)),
+        'phone': Column(String(250)),
+        'website': Column(String(250)),
+        'majors': Column(String(500)),
+        'minors': Column(String(500)),
+        'graduate': Column(String(250)),
+        'preprofessional': Column(String(250)),
+        'class_standing': Column(String(250)),
+        'high_school': Column(String(250)),
+        'class_of': Column(String(250)),
+        'relationship_status': Column(String(250)),
+        'attached_to': Column(String(250)),
+        'quote': Column(String(1000)),
+        'quote_author': Column(String(250)),
+        'hobbies': Column(String(500)),
+        'career_goals': Column(String(1000)),
+        'favorite_books': Column(String(1000)),
+        'favorite_food': Column(String(1000)),
+        'favorite_movies': Column(String(1000)),
+        'favorite_music': Column(String(1000)),
+        'pet_peeves': Column(String(500)),
+        'personality': Column(String(250)),
+        'views': Column(Integer),
+        'privacy': Column(Integer),
+        'department': Column(String(250)),
+        'office': Column(String(250)),
+        'office_hours': Column(String(250)),
+    }
+
+
+# models are only built the first time someone asks for that year
+_archive_models = {}
+_archive_models_lock = threading.Lock()
+
+
+# e.g. get_archive_model("1617") returns the Archive1617 model for the profiles1617 table
 def get_archive_model(archive_year):
-    return eval("Archive" + str(archive_year))
-
-
-for year in ["1617", "1516", "1415", "1314", "1213", "1112", "1011", "0910", "0809", "0708", "0607"]:
-    set_archive_columns(get_archive_model(year))
+    archive_year = str(archive_year)
+    if archive_year not in ARCHIVE_YEARS:
+        raise ValueError("no archive for " + archive_year)
+    with _archive_models_lock:
+        if archive_year not in _archive_models:
+            attributes = archive_columns()
+            attributes['__tablename__'] = 'profiles' + archive_year
+            _archive_models[archive_year] = type('Archive' + archive_year, (ArchiveBase,), attributes)
+    return _archive_models[archive_year]
@@ -0,0 +1,66 @@
+# async_alchemy.py
+
+# runs blocking database work on a bounded pool of threads
+# so a slow query never holds up the IOLoop (and every other request with it)
+# usage inside a @gen.coroutine handler: `results = yield async_alchemy.run(some_function, arg1, arg2)`
+
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+import tornado.web
+from tornado.options import define, options
+
+import src.aswwu.alchemy as alchemy
+
+logger = logging.getLogger("aswwu")
+
+define("db_pool_size", default=4, help="number of threads running database queries")
+define("db_queue_depth", default=100, help="number of queries allowed to wait for a thread before we start refusing")
+
+
+# too much is already waiting on the database, so the request gets a 503 instead of joining the queue
+class DatabaseBusy(tornado.web.HTTPError):
+    def __init__(self):
+        tornado.web.HTTPError.__init__(self, 503, "database queue is full")
+
+
+_executor = None
+_pending = 0
+_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=options.db_pool_size)
+    return _executor
+
+
+def _call(fn, args, kwargs):
+    global _pending
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        # the sessions belong to this worker thread, so close them before it picks up another job
+        alchemy.remove_sessions()
+        with _lock:
+            _pending -= 1
+
+
+# runs fn(*args, **kwargs) on the pool and returns a Future for its result
+# fn should return plain data (e.g. to_json() output), since its session is closed as soon as it's done
+def run(fn, *args, **kwargs):
+    global _pending
+    with _lock:
+        if _pending >= options.db_pool_size + options.db_queue_depth:
+            logger.error("async_alchemy: database queue is full")
+            raise DatabaseBusy()
+        _pending += 1
+    try:
+        return executor().submit(_call, fn, args, kwargs)
+    except Exception:
+        with _lock:
+            _pending -= 1
+        raise
@@ -1,14 +1,21 @@
 # base_handlers.py
 
+import base64
 import datetime
+import functools
 import hashlib
 import hmac
 import json
 import logging
+import threading
 import time
 
 import requests
+import tornado.escape
+import tornado.gen
+import tornado.iostream
 import tornado.web
+from tornado.options import define, options
 
 from settings import testing
 
@@ -16,9 +23,23 @@ from settings import testing
 import src.aswwu.models.mask as mask_model
 import src.aswwu.alchemy as alchemy
 import src.aswwu.archive_models as archives
+import src.aswwu.async_alchemy as async_alchemy
+import src.aswwu.caching as caching
+import src.aswwu.name_index as name_index
+import src.aswwu.photo_map as photo_map
+import src.aswwu.revocations as revocations
 
 logger = logging.getLogger("aswwu")
 
+# number of requests this process is in the middle of, so it can drain them before shutting down
+active_requests = 0
+
+define("stream_batch_size", default=500, help="rows read per database trip by streamed responses")
+
+# tokens starting with this carry signed claims about the user
+# tokens without it are the old `wwuid|timestamp|hmac` kind
+TOKEN_VERSION = "2"
+
 
 # model used only in this file
 # acts as an extension of the User and Profile models
@@ -28,23 +49,28 @@ def import_profile(profile, exported_json):
             setattr(profile, field, exported_json[field])
 
 
+# db is the people session to look them up with when there are no claims, see BaseHandler.people_db
 class LoggedInUser:
-    def __init__(self, wwuid):
+    def __init__(self, wwuid, claims=None, db=None):
         self.wwuid = wwuid
-        profile = alchemy.query_by_wwuid(mask_model.Profile, wwuid)
-        user = alchemy.query_user(wwuid)
-        if len(profile) == 0:
-            old_profile = alchemy.archive_db.query(archives.get_archive_model(get_last_year())).\
-                filter_by(wwuid=str(wwuid)).all()
-            new_profile = mask_model.Profile(wwuid=str(wwuid), username=user.username, full_name=user.full_name)
-            if len(old_profile) == 1:
-                import_profile(new_profile, old_profile[0].export_info())
-            profile = alchemy.add_or_update(new_profile)
-        else:
-            profile = profile[0]
+        # claims come from a validated token, so there's no need to ask the database
+        if claims is not None:
+            self.username = claims['username']
+            self.full_name = claims['full_name']
+            self.photo = claims['photo']
+            self.roles = claims['roles']
+            self.status = claims['status']
+            return
+        user = alchemy.query_identity(wwuid, db)
         self.username = user.username
-        self.full_name = profile.full_name
-        self.photo = profile.photo
+        if user.profile_id is None:
+            # first time we've seen them this year, their profile gets created in the background
+            provision_profile(wwuid)
+            self.full_name = user.user_full_name
+            self.photo = None
+        else:
+            self.full_name = user.full_name
+            self.photo = user.photo
         if user.roles:
             self.roles = user.roles.split(',')
         else:
@@ -55,6 +81,21 @@ class LoggedInUser:
         return {'wwuid': str(self.wwuid), 'username': self.username, 'full_name': self.full_name,
                 'photo': self.photo, 'roles': ','.join(self.roles), 'status': self.status}
 
+    def claims(self):
+        return {'username': self.username, 'full_name': self.full_name, 'photo': self.photo,
+                'roles': self.roles, 'status': self.status}
+
+
+# look the user up in the identity cache before going to the database
+# only call this with a wwuid that came from a validated token
+def load_user(wwuid, db=None):
+    cache = caching.identity_cache()
+    user = cache.get(str(wwuid))
+    if user is None:
+        user = LoggedInUser(wwuid, db=db)
+        cache.set(str(wwuid), user)
+    return user
+
 
 # this is the root/base handler for all other handlers
 class BaseHandler(tornado.web.RequestHandler):
@@ -75,19 +116,36 @@ class BaseHandler(tornado.web.RequestHandler):
         signature = hmac.new(secret, message, digestmod=hashlib.sha256).hexdigest()
         return signature
 
-    # create a authorization token for the given WWUID based on the current time
-    def generate_token(self, wwuid):
+    # create a authorization token for the given user based on the current time
+    # the token looks like `2|wwuid|timestamp|claims|hmac` where claims is the user's info as base64 JSON
+    def generate_token(self, user):
         now = int(time.mktime(datetime.datetime.now().timetuple()))
-        message = str(wwuid)+"|"+str(now)
+        claims = user.claims()
+        claims['exp'] = now + options.token_claims_ttl
+        claims = base64.urlsafe_b64encode(json.dumps(claims, separators=(',', ':'))).rstrip('=')
+        message = "|".join([TOKEN_VERSION, str(user.wwuid), str(now), claims])
         return message+"|"+self.generate_hmac_digest(message)
 
+    # split up a token (old or new style) into (wwuid, timestamp, claims)
+    # returns None if the token has been tampered with (i.e. copied or stolen)
+    def parse_token(self, token):
+        token = str(token).split("|")
+        if len(token) == 3:
+            wwuid, date_created, claims = token[0], token[1], None
+        elif len(token) == 5 and token[0] == TOKEN_VERSION:
+            wwuid, date_created, claims = token[1], token[2], token[3]
+        else:
+            return None
+        compare_to = self.generate_hmac_digest("|".join(token[:-1]))
+        if not hmac.compare_digest(compare_to, token[-1]):
+            return None
+        if claims is not None:
+            claims = json.loads(base64.urlsafe_b64decode(claims + '=' * (-len(claims) % 4)))
+        return wwuid, int(date_created), claims
+
     # see if the authorization token received from the user has been tampered with (i.e. copied or stolen)
     def validate_token(self, token):
-        token = token.split("|")
-        if len(token) != 3:
-            return False
-        compare_to = self.generate_hmac_digest(token[0] + "|" + token[1])
-        return compare_to == token[2]
+        return self.parse_token(token) is not None
 
     # global hook that allows the @tornado.web.authenticated decorator to function
     # checks for an authorization header and attempts to validate the user with that information
@@ -99,23 +157,144 @@ class BaseHandler(tornado.web.RequestHandler):
                     self.set_cookie('token', '', domain='.aswwu.com', expires_days=14)
                     logger.error("There was no cookie! You're not logged in!")
                 else:
-                    token = self.get_cookie("token")
-                    wwuid = token.split("|")[0]
-                    date_created = int(token.split("|")[1])
+                    token = self.parse_token(self.get_cookie("token"))
                     now = int(time.mktime(datetime.datetime.now().timetuple()))
                     # check if token was created with the last 2 weeks (14 days) and is a valid token
-                    if (now - date_created) > (60 * 60 * 24 * 14) or not self.validate_token(token):
+                    if token is None or (now - token[1]) > (60 * 60 * 24 * 14):
                         user = None
                     else:
-                        user = LoggedInUser(wwuid)
+                        wwuid, date_created, claims = token
+                        # fresh claims that haven't been revoked are enough, no database needed
+                        if claims and claims['exp'] >= now and not caching.claims_revoked(wwuid, date_created):
+                            user = LoggedInUser(wwuid, claims)
+                        else:
+                            user = load_user(wwuid, self.people_db)
             except:
                 user = None
 
             return user
         else:
-            return LoggedInUser(testing['developer'])
+            return load_user(testing['developer'], self.people_db)
+
+    # sends a caching.CachedBody (JSON) the way the client wants it:
+    # a 304 if their copy is still current, gzipped if they accept that, or as is
+    def write_cached_body(self, cached):
+        gzipped = "gzip" in self.request.headers.get("Accept-Encoding", "")
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.set_header("Vary", "Accept-Encoding")
+        self.set_header("Etag", cached.gzip_etag if gzipped else cached.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+        elif gzipped:
+            self.set_header("Content-Encoding", "gzip")
+            self.write(cached.gzipped)
+        else:
+            self.write(cached.body)
+
+    # sends a caching.CachedResponse, see cached_response
+    def write_cached_response(self, cached):
+        if cached.body:
+            self.write_cached_body(cached)
+        for name, value in cached.headers:
+            self.set_header(name, value)
+        if self.get_status() != 304:
+            self.set_status(cached.status)
+
+    # everything written while this is a list gets a copy in it, see cached_response
+    _captured = None
+
+    def flush(self, include_footers=False, callback=None):
+        if self._captured is not None:
+            self._captured.append(b"".join(self._write_buffer))
+        return tornado.web.RequestHandler.flush(self, include_footers, callback)
+
+    # writes {key: [...]} without ever having the whole list in memory
+    # fetch_batch(after, size) runs on the database threads (see async_alchemy), it returns the next
+    # (up to) size items ready for JSON and what to pass as `after` next time, or None when there are no more
+    # each batch goes out to the client before the next one is read
+    # returns the whole body if collect is set (e.g. to cache it), otherwise None
+    # if a batch can't be read the error is raised, once part of the body has gone out the connection
+    # is closed as well, so the client can't mistake what it got for the whole list
+    @tornado.gen.coroutine
+    def write_json_stream(self, key, fetch_batch, collect=False):
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        chunks = []
+        chunk = "{" + tornado.escape.json_encode(key) + ": ["
+        after = None
+        first = True
+        while True:
+            try:
+                items, after = yield async_alchemy.run(fetch_batch, after, options.stream_batch_size)
+            except Exception:
+                # nothing that was streamed is worth caching (see cached_response)
+                self._captured = None
+                if self._headers_written:
+                    self.request.connection.close()
+                raise
+            for item in items:
+                chunk += ("" if first else ", ") + tornado.escape.json_encode(item)
+                first = False
+            if after is None:
+                break
+            self.write(chunk)
+            if collect:
+                chunks.append(chunk)
+            chunk = ""
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                # they've gone, no point reading the rest (or caching what they got, see cached_response)
+                self._captured = None
+                raise tornado.gen.Return(None)
+        chunk += "]}"
+        self.write(chunk)
+        if collect:
+            chunks.append(chunk)
+            raise tornado.gen.Return("".join(chunks))
+
+    # this request's own sessions (see alchemy.RequestSessions), pass them to the alchemy helpers
+    # requests take turns on the IOLoop thread, so they can't share that thread's scoped sessions
+    # work handed to async_alchemy uses the database thread's sessions instead
+    @property
+    def people_db(self):
+        return self.sessions.get(alchemy.dbs)
+
+    @property
+    def archive_db(self):
+        return self.sessions.get(alchemy.archive_dbs)
+
+    @property
+    def election_db(self):
+        return self.sessions.get(alchemy.election_dbs)
+
+    @property
+    def page_db(self):
+        return self.sessions.get(alchemy.pages_dbs)
+
+    @property
+    def jobs_db(self):
+        return self.sessions.get(alchemy.jobs_dbs)
+
+    # the session a year's profiles live in, the current year's or the archives
+    def year_db(self, year):
+        if year == tornado.options.options.current_year:
+            return self.people_db
+        return self.archive_db
+
+    # sessions only live as long as the request that used them
+    def on_finish(self):
+        global active_requests
+        if getattr(self, 'sessions', None) is not None:
+            self.sessions.close()
+        if getattr(self, '_active', False):
+            active_requests -= 1
+            self._active = False
 
     def prepare(self):
+        global active_requests
+        active_requests += 1
+        self._active = True
+        self.sessions = alchemy.RequestSessions()
         # some modern JS frameworks force data to be sent as JSON
         # this isn't a bad thing at all, just requires us to "prepare" the data before it's used internally
         if "Content-Type" in self.request.headers and self.request.headers["Content-Type"].\
@@ -129,6 +308,51 @@ class BaseHandler(tornado.web.RequestHandler):
                 pass
 
 
+# caches the responses of a GET handler that sends everyone the same thing (see caching.ResponseCache)
+# key(handler, *args) picks which copy a request gets, or returns None to skip the cache (e.g. for logged in users)
+# tags are the tables the response is read from, a commit writing to any of them throws it away
+# (or alchemy.PHOTOS_TAG, for responses that only depend on who has which photo)
+# ttl (seconds, response_cache_ttl by default) covers everything else, e.g. other processes' writes
+# only successful responses and redirects are kept
+def cached_response(key, tags=(), ttl=None):
+    def decorator(method):
+        @functools.wraps(method)
+        @tornado.gen.coroutine
+        def wrapper(self, *args, **kwargs):
+            cache_key = key(self, *args)
+            if cache_key is None:
+                yield tornado.gen.maybe_future(method(self, *args, **kwargs))
+                return
+            name = type(self).__name__
+            cached = caching.cached_response(name, cache_key)
+            if cached is not None:
+                self.write_cached_response(cached)
+                return
+            generations = caching.tag_generations(tags)
+            self._captured = []
+            yield tornado.gen.maybe_future(method(self, *args, **kwargs))
+            captured, self._captured = self._captured, None
+            if captured is not None and self.get_status() < 400:
+                headers = [(header, self._headers[header]) for header in ("Content-Type", "Location")
+                           if header in self._headers]
+                body = b"".join(captured) + b"".join(self._write_buffer)
+                caching.set_cached_response(name, cache_key, caching.CachedResponse(self.get_status(), headers, body),
+                                            generations, ttl)
+        return wrapper
+    return decorator
+
+
+# hit and miss counts of the response cache, for administrators
+class ResponseCacheStatsHandler(BaseHandler):
+    @tornado.web.authenticated
+    def get(self):
+        if 'administrator' not in self.current_user.roles:
+            self.set_status(401)
+            self.write({'error': 'insufficient permissions'})
+        else:
+            self.write({'responses': caching.response_cache_stats(), 'size': len(caching.response_cache())})
+
+
 # effectively useless, but at least provides an endpoint for people accessing "/" by accident
 class BaseIndexHandler(BaseHandler):
     @tornado.web.authenticated
@@ -181,7 +405,9 @@ class BaseVerifyLoginHandler(BaseHandler):
         user = self.current_user
         if user:
             # if a user exists, refresh their token for them
-            token = self.generate_token(user.wwuid)
+            # the user is reloaded so role changes make it into the new claims
+            user = load_user(user.wwuid, self.people_db)
+            token = self.generate_token(user)
             self.write({'user': user.to_json(), 'token': token})
             self.set_cookie("token", token, domain='.aswwu.com', expires_days=14)
         else:
@@ -192,3 +418,49 @@ class BaseVerifyLoginHandler(BaseHandler):
 def get_last_year():
     year = tornado.options.options.current_year
     return str(int(year[:2]) - 1) + str(int(year[2:4]) - 1)
+
+
+# wwuids that already have a profile waiting to be created
+_pending_profiles = set()
+_pending_profiles_lock = threading.Lock()
+
+
+# create a user's profile for this year on the database threads (see async_alchemy)
+# so the request that noticed it's missing doesn't wait on the archive lookup and the insert
+def provision_profile(wwuid):
+    with _pending_profiles_lock:
+        if str(wwuid) in _pending_profiles:
+            return
+        _pending_profiles.add(str(wwuid))
+    try:
+        async_alchemy.run(create_profile, wwuid)
+    except async_alchemy.DatabaseBusy:
+        # it'll be tried again on their next request
+        with _pending_profiles_lock:
+            _pending_profiles.discard(str(wwuid))
+
+
+# copy over what we can from last year's profile, or start from scratch if they weren't around then
+# runs on the database threads, see provision_profile()
+def create_profile(wwuid):
+    try:
+        if alchemy.people_db.query(mask_model.Profile.id).filter_by(wwuid=str(wwuid)).first() is None:
+            user = alchemy.query_user(wwuid)
+            old_profile = []
+            if alchemy.database_exists('archives'):
+                old_profile = alchemy.archive_db.query(archives.get_archive_model(get_last_year())).\
+                    filter_by(wwuid=str(wwuid)).all()
+            new_profile = mask_model.Profile(wwuid=str(wwuid), username=user.username, full_name=user.full_name)
+            if len(old_profile) == 1:
+                import_profile(new_profile, old_profile[0].export_info())
+            alchemy.add_or_update(new_profile)
+            # the cached user was built without a profile
+            revocations.revoke(wwuid)
+            name_index.update_profile(new_profile)
+            photo_map.update_profile(new_profile)
+    except Exception as e:
+        logger.error("create_profile: error " + str(e))
+        alchemy.people_db.rollback()
+    finally:
+        with _pending_profiles_lock:
+            _pending_profiles.discard(str(wwuid))
@@ -0,0 +1,220 @@
+# caching.py
+
+# small in-process caches shared by the handlers
+# everything here lives in a single server process, so each worker keeps its own copy
+# (revocations.py passes revoked users on to the others)
+
+import collections
+import gzip
+import hashlib
+import io
+import threading
+import time
+
+from tornado.options import define, options
+
+define("identity_cache_size", default=5000, help="max number of logged in users kept in memory")
+define("identity_cache_ttl", default=300, help="seconds a cached logged in user stays valid")
+define("token_claims_ttl", default=300, help="seconds the signed claims inside a token are trusted")
+define("response_cache_size", default=1000, help="max number of whole responses kept in memory")
+define("response_cache_ttl", default=60, help="seconds a cached response is sent for, unless its handler says otherwise")
+
+
+# a size bounded, least recently used cache where every entry also expires after `ttl` seconds
+class LRUCache(object):
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert so the entry moves to the most recently used end
+            self._entries[key] = entry
+            return value
+
+    # ttl overrides the cache's own for just this entry
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+            # evict the least recently used entries once we go over the limit
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# logged in users keyed by wwuid
+# created on first use so the sizes come from the parsed config file
+_identity_cache = None
+_identity_cache_lock = threading.Lock()
+
+
+def identity_cache():
+    global _identity_cache
+    with _identity_cache_lock:
+        if _identity_cache is None:
+            _identity_cache = LRUCache(options.identity_cache_size, options.identity_cache_ttl)
+    return _identity_cache
+
+
+# wwuid -> time that user's token claims were revoked
+# tokens issued at or before that time have to go back to the database for the user
+_revoked_claims = {}
+_revoked_claims_lock = threading.Lock()
+
+
+# revoked_at defaults to now, it's earlier for revocations other processes made (see revocations.py)
+def revoke_claims(wwuid, revoked_at=None):
+    now = time.time()
+    if revoked_at is None:
+        revoked_at = now
+    with _revoked_claims_lock:
+        # claims older than the ttl have expired on their own, so there's no need to remember them
+        for key, when in _revoked_claims.items():
+            if when < now - options.token_claims_ttl:
+                del _revoked_claims[key]
+        _revoked_claims[str(wwuid)] = max(revoked_at, _revoked_claims.get(str(wwuid), 0))
+
+
+def claims_revoked(wwuid, issued):
+    revoked_at = _revoked_claims.get(str(wwuid))
+    return revoked_at is not None and issued <= revoked_at
+
+
+# this only reaches this process's caches, use revocations.revoke() when a user's name, photo, roles or status change
+def invalidate_user(wwuid, revoked_at=None):
+    identity_cache().invalidate(str(wwuid))
+    revoke_claims(wwuid, revoked_at)
+
+
+# a response body along with everything needed to send it again: a gzipped copy and strong ETags for both
+class CachedBody(object):
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+            f.write(body)
+        self.gzipped = buf.getvalue()
+        digest = hashlib.sha1(body).hexdigest()
+        self.etag = '"' + digest + '"'
+        # the gzipped copy is a different set of bytes, so it gets its own strong ETag
+        self.gzip_etag = '"' + digest + '-gzip"'
+
+
+# response bodies keyed by name, each good for as long as the version of the tables it was built from
+# the version is whatever the caller uses to tell, e.g. alchemy.query_table_versions()
+_bodies = {}
+_bodies_lock = threading.Lock()
+
+
+# the cached body for key if it was built from this version, otherwise None
+def versioned_body(key, version):
+    with _bodies_lock:
+        cached = _bodies.get(key)
+    if cached is None or version is None or cached.version != version:
+        return None
+    return cached
+
+
+def set_versioned_body(key, version, body):
+    cached = CachedBody(version, body)
+    # with no version there's nothing to check it against later
+    if version is not None:
+        with _bodies_lock:
+            _bodies[key] = cached
+    return cached
+
+
+# a whole response (status, the headers that matter and the body) that can be sent again as is
+class CachedResponse(CachedBody):
+    def __init__(self, status, headers, body):
+        CachedBody.__init__(self, None, body)
+        self.status = status
+        # e.g. [('Content-Type', ...), ('Location', ...)]
+        self.headers = headers
+
+
+# responses of GET handlers that send everyone the same thing, see base_handlers.cached_response
+# each is kept until its ttl runs out or something is committed to one of the tables it's tagged with
+# (alchemy calls invalidate_tags() after every commit), changes made by other processes wait for the ttl
+_responses = None
+# tag (table name) -> how many times it has been invalidated
+# every cached response remembers these counts for its tags and is thrown away on read once one has moved on,
+# so there's nothing to clean up when responses are evicted or expire
+_tag_generations = {}
+# handler name -> [hits, misses]
+_response_stats = {}
+_responses_lock = threading.Lock()
+
+
+def response_cache():
+    global _responses
+    with _responses_lock:
+        if _responses is None:
+            _responses = LRUCache(options.response_cache_size, options.response_cache_ttl)
+    return _responses
+
+
+# take these before building a response and pass them to set_cached_response()
+# that way a commit made while it was being built still throws it away
+def tag_generations(tags):
+    with _responses_lock:
+        return tuple((tag, _tag_generations.get(tag, 0)) for tag in tags)
+
+
+# the cached response for this handler and key, or None, counted as a hit or a miss
+def cached_response(name, key):
+    entry = response_cache().get((name, key))
+    cached = None
+    with _responses_lock:
+        if entry is not None:
+            response, generations = entry
+            if all(_tag_generations.get(tag, 0) == generation for tag, generation in generations):
+                cached = response
+        stats = _response_stats.setdefault(name, [0, 0])
+        stats[0 if cached is not None else 1] += 1
+    if entry is not None and cached is None:
+        response_cache().invalidate((name, key))
+    return cached
+
+
+def set_cached_response(name, key, response, generations=(), ttl=None):
+    response_cache().set((name, key), (response, generations), ttl)
+
+
+def invalidate_tags(tags):
+    with _responses_lock:
+        for tag in tags:
+            _tag_generations[tag] = _tag_generations.get(tag, 0) + 1
+
+
+def clear_responses():
+    response_cache().clear()
+    with _responses_lock:
+        _tag_generations.clear()
+        _response_stats.clear()
+
+
+# {handler name: {'hits': ..., 'misses': ...}}
+def response_cache_stats():
+    with _responses_lock:
+        return dict((name, {'hits': hits, 'misses': misses}) for name, (hits, misses) in _response_stats.items())
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, String, Boolean
+from sqlalchemy import Column, ForeignKey, Index, String, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -22,5 +22,6 @@ class AskAnything(Base):
 
 
 class AskAnythingVote(Base):
+    __table_args__ = (Index('ix_askanythingvotes_question_id_voter', 'question_id', 'voter'),)
     question_id = Column(String(50), ForeignKey('askanythings.id'))
     voter = Column(String(75), nullable=False)
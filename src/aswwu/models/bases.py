@@ -4,7 +4,6 @@ import logging
 import uuid
 
 import six
-from pattern.en import pluralize
 from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 
@@ -16,12 +15,43 @@ def uuid_gen():
     return str(uuid.uuid4())
 
 
+# every model will have a corresponding table that is the lowercase and pluralized version of it's name
+# these are written out ahead of time rather than worked out with a pluralizer on every startup
+# any model missing from here just gets an "s" on the end
+TABLE_NAMES = {
+    'askanything': 'askanythings',
+    'askanythingvote': 'askanythingvotes',
+    'election': 'elections',
+    'jobanswer': 'jobanswers',
+    'jobapplication': 'jobapplications',
+    'jobform': 'jobforms',
+    'jobquestion': 'jobquestions',
+    'page': 'pages',
+    'pageeditor': 'pageeditors',
+    'pagetag': 'pagetags',
+    'profile': 'profiles',
+    'profileview': 'profileviews',
+    'profileviewday': 'profileviewdays',
+    'profileviewevent': 'profileviewevents',
+    'profileviewhour': 'profileviewhours',
+    'revocation': 'revocations',
+    'tableversion': 'tableversions',
+    'user': 'users',
+    'volunteer': 'volunteers',
+}
+
+
+def table_name(model_name):
+    model_name = model_name.lower()
+    return TABLE_NAMES.get(model_name, model_name + 's')
+
+
 # define a base model for all other models
 class Base(object):
     @declared_attr
     def __tablename__(self):
         # every model will have a corresponding table that is the lowercase and pluralized version of it's name
-        return pluralize(self.__name__.lower())
+        return table_name(self.__name__)
 
     # every model should also have an ID as a primary key
     # as well as a column indicated when the data was last updated
@@ -29,37 +59,101 @@ class Base(object):
     updated_at = Column(DateTime, onupdate=datetime.datetime.now())
 
     # a useful function is being able to call `model.to_json()` and getting valid JSON to send to the user
+    # if called with `model.to_json(skip_list=["something"])` then "something" will be skipped
+    # if called with `model.to_json(limitList=["something"])` then only those columns will even be checked
+    # by default we check all of the table's columns
+    # values are utf-8 strings, anything that can't be one is 'None' (see json_value), views are counted
     def to_json(self, **kwargs):
-        obj = {}
-        # get the column names of the table
-        columns = [str(key).split(".")[1] for key in self.__table__.columns]
-        # if called with `model.to_json(skipList=["something"])`
-        # then "something" will be added to the list of columns to skip
-        skip_list = ['id'] + kwargs.get('skip_list', [])
-        # if called similarly to skipList, then only those columns will even be checked
-        # by default we check all of the table's columns
-        limit_list = kwargs.get('limitList', columns)
-        for key in limit_list:
-            if key not in skip_list and key != "views":
-                # fancy way of saying "self.key"
-                value = getattr(self, key)
-                # try to set the value as a utf-8 string
-                try:
-                    if not isinstance(value, six.string_types):
-                        value = str(value)
-                    obj[key] = value.encode("utf-8")
-                # if that doesn't work set the object to 'None' (output of str(None))
-                except Exception as e:
-                    obj[key] = 'None'
-                    logger.debug("obj[{}] = {} failed to json encode in to_json. Error message: {}".format(key, value, e))
-                    pass
-
+        return serializer(type(self), kwargs.get('limitList'), kwargs.get('skip_list', []), UTF8)(self)
 
+    # the same as to_json(limitList=keys) for a row of columns picked out by a query (see Query.with_entities)
+    # "views" has to be one of the columns, as the total number of views
+    @classmethod
+    def row_to_json(cls, row, keys):
+        obj = {}
+        for key in keys:
+            if key != 'id' and key != "views":
+                obj[key] = json_value(key, getattr(row, key))
             elif key == "views":
-                obj[key] = str(self.num_views())
+                obj[key] = str(row.views)
         return obj
 
 
+# try to set the value as a utf-8 string
+# if that doesn't work set it to 'None' (output of str(None))
+def json_value(key, value):
+    try:
+        if not isinstance(value, six.string_types):
+            value = str(value)
+        return value.encode("utf-8")
+    except Exception as e:
+        logger.debug("obj[{}] = {} failed to json encode in to_json. Error message: {}".format(key, value, e))
+        return 'None'
+
+
+# the two ways our to_json()s turn values into strings
+UTF8 = 'utf8'
+STR = 'str'
+
+
+# to_json used to work out the table's column names and which of them to skip on every single call
+# this does it once per model and set of fields (e.g. base_info's) and keeps the function it builds on the class
+# so each call after the first only reads and converts values, with exactly the same output
+def serializer(cls, limit_list, skip_list, convert):
+    key = (None if limit_list is None else tuple(limit_list), tuple(skip_list), convert)
+    serializers = cls.__dict__.get('_serializers')
+    if serializers is None:
+        serializers = {}
+        setattr(cls, '_serializers', serializers)
+    serialize = serializers.get(key)
+    if serialize is None:
+        serialize = serializers[key] = compile_serializer(cls, limit_list, skip_list, convert)
+    return serialize
+
+
+def compile_serializer(cls, limit_list, skip_list, convert):
+    # get the column names of the table
+    columns = [str(key).split(".")[1] for key in cls.__table__.columns]
+    skip_list = ['id'] + list(skip_list)
+    if limit_list is None:
+        limit_list = columns
+    text_type = six.text_type
+
+    if convert == UTF8:
+        # views are counted (see Profile.num_views) even if they're in skip_list
+        fields = [(key, key == "views") for key in limit_list if key not in skip_list or key == "views"]
+
+        def serialize(thing):
+            obj = {}
+            # loaded values are read straight from the instance, saving a trip through the attribute machinery
+            values = thing.__dict__
+            for key, views in fields:
+                if views:
+                    obj[key] = str(thing.num_views())
+                    continue
+                value = values[key] if key in values else getattr(thing, key)
+                if value.__class__ is text_type:
+                    obj[key] = value.encode("utf-8")
+                else:
+                    obj[key] = json_value(key, value)
+            return obj
+    else:
+        fields = [key for key in limit_list if key not in skip_list]
+
+        def serialize(thing):
+            obj = {}
+            values = thing.__dict__
+            for key in fields:
+                value = values[key] if key in values else getattr(thing, key)
+                # NOTE: this should be encoded more properly sometime
+                try:
+                    obj[key] = str(value)
+                except Exception:
+                    pass
+            return obj
+    return serialize
+
+
 Base = declarative_base(cls=Base)
 
 
@@ -67,7 +161,7 @@ class ElectionBase(object):
     @declared_attr
     def __tablename__(self):
         # every model will have a corresponding table that is the lowercase and pluralized version of it's name
-        return pluralize(self.__name__.lower())
+        return table_name(self.__name__)
 
     # every model should also have an ID as a primary key
     # as well as a column indicated when the data was last updated
@@ -75,27 +169,12 @@ class ElectionBase(object):
     updated_at = Column(DateTime, onupdate=datetime.datetime.now)
 
     # a useful function is being able to call `model.to_json()` and getting valid JSON to send to the user
+    # if called with `model.to_json(skip_list=["something"])` then "something" will be skipped
+    # if called with `model.to_json(limit_list=["something"])` then only those columns will even be checked
+    # by default we check all of the table's columns
+    # values are str()'d, anything that can't be is left out
     def to_json(self, **kwargs):
-        obj = {}
-        # get the column names of the table
-        columns = [str(key).split(".")[1] for key in self.__table__.columns]
-        # if called with `model.to_json(skipList=["something"])`
-        # then "something" will be added to the list of columns to skip
-        skip_list = ['id'] + kwargs.get('skip_list', [])
-        # if called similarly to skipList, then only those columns will even be checked
-        # by default we check all of the table's columns
-        limit_list = kwargs.get('limit_list', columns)
-        for key in limit_list:
-            if key not in skip_list:
-                # fancy way of saying "self.key"
-                value = getattr(self, key)
-                # try to set the value as a string, but that doesn't always work
-                # NOTE: this should be encoded more properly sometime
-                try:
-                    obj[key] = str(value)
-                except Exception as e:
-                    pass
-        return obj
+        return serializer(type(self), kwargs.get('limit_list'), kwargs.get('skip_list', []), STR)(self)
 
 
 ElectionBase = declarative_base(cls=ElectionBase)
@@ -105,7 +184,7 @@ class PagesBase(object):
     @declared_attr
     def __tablename__(self):
         # every model will have a corresponding table that is the lowercase and pluralized version of it's name
-        return pluralize(self.__name__.lower())
+        return table_name(self.__name__)
 
     # every model should also have an ID as a primary key
     # as well as a column indicated when the data was last updated
@@ -114,27 +193,12 @@ class PagesBase(object):
 
     # a useful function is being able to call `model.to_json()` and getting valid JSON to send to the user
     # TODO: Make this properly print multilevel lists. (ex. tags, editors)
+    # if called with `model.to_json(skip_list=["something"])` then "something" will be skipped
+    # if called with `model.to_json(limit_list=["something"])` then only those columns will even be checked
+    # by default we check all of the table's columns
+    # values are str()'d, anything that can't be is left out
     def to_json(self, **kwargs):
-        obj = {}
-        # get the column names of the table
-        columns = [str(key).split(".")[1] for key in self.__table__.columns]
-        # if called with `model.to_json(skipList=["something"])`
-        # then "something" will be added to the list of columns to skip
-        skip_list = ['id'] + kwargs.get('skip_list', [])
-        # if called similarly to skipList, then only those columns will even be checked
-        # by default we check all of the table's columns
-        limit_list = kwargs.get('limit_list', columns)
-        for key in limit_list:
-            if key not in skip_list:
-                # fancy way of saying "self.key"
-                value = getattr(self, key)
-                # try to set the value as a string, but that doesn't always work
-                # NOTE: this should be encoded more properly sometime
-                try:
-                    obj[key] = str(value)
-                except Exception as e:
-                    pass
-        return obj
+        return serializer(type(self), kwargs.get('limit_list'), kwargs.get('skip_list', []), STR)(self)
 
 
 PagesBase = declarative_base(cls=PagesBase)
@@ -144,7 +208,7 @@ class JobsBase(object):
     @declared_attr
     def __tablename__(self):
         # every model will have a corresponding table that is the lowercase and pluralized version of it's name
-        return pluralize(self.__name__.lower())
+        return table_name(self.__name__)
 
     # every model should also have an ID as a primary key
     # as well as a column indicated when the data was last updated
@@ -153,27 +217,12 @@ class JobsBase(object):
 
     # a useful function is being able to call `model.to_json()` and getting valid JSON to send to the user
     # TODO: Make this properly print multilevel lists. (ex. tags, editors)
+    # if called with `model.to_json(skip_list=["something"])` then "something" will be skipped
+    # if called with `model.to_json(limit_list=["something"])` then only those columns will even be checked
+    # by default we check all of the table's columns
+    # values are str()'d, anything that can't be is left out
     def to_json(self, **kwargs):
-        obj = {}
-        # get the column names of the table
-        columns = [str(key).split(".")[1] for key in self.__table__.columns]
-        # if called with `model.to_json(skipList=["something"])`
-        # then "something" will be added to the list of columns to skip
-        skip_list = ['id'] + kwargs.get('skip_list', [])
-        # if called similarly to skipList, then only those columns will even be checked
-        # by default we check all of the table's columns
-        limit_list = kwargs.get('limit_list', columns)
-        for key in limit_list:
-            if key not in skip_list:
-                # fancy way of saying "self.key"
-                value = getattr(self, key)
-                # try to set the value as a string, but that doesn't always work
-                # NOTE: this should be encoded more properly sometime
-                try:
-                    obj[key] = str(value)
-                except Exception as e:
-                    pass
-        return obj
+        return serializer(type(self), kwargs.get('limit_list'), kwargs.get('skip_list', []), STR)(self)
 
 
 JobsBase = declarative_base(cls=JobsBase)
@@ -17,7 +17,7 @@ class User(ElectionBase):
 
 
 class Election(ElectionBase):
-    wwuid = Column(String(7), ForeignKey('users.wwuid'), nullable=False)
+    wwuid = Column(String(7), ForeignKey('users.wwuid'), nullable=False, index=True)
     candidate_one = Column(String(50))
     candidate_two = Column(String(50))
     sm_one = Column(String(50))
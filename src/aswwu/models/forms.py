@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, String, Boolean
+from sqlalchemy import Column, ForeignKey, Index, String, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -38,6 +38,7 @@ class JobQuestion(JobsBase):
 
 
 class JobApplication(JobsBase):
+    __table_args__ = (Index('ix_jobapplications_jobID_username', 'jobID', 'username'),)
     jobID = Column(String(50), ForeignKey('jobforms.id'))
     answers = relationship("JobAnswer", backref="jobapplications", lazy="joined")
     username = Column(String(100), nullable=False)
@@ -56,6 +57,7 @@ class JobApplication(JobsBase):
 
 
 class JobAnswer(JobsBase):
+    __table_args__ = (Index('ix_jobanswers_applicationID_questionID', 'applicationID', 'questionID'),)
     questionID = Column(String(50), ForeignKey('jobquestions.id'))
     answer = Column(String(10000))
     applicationID = Column(String(50), ForeignKey('jobapplications.id'))
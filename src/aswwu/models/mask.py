@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import Column, Date, Float, ForeignKey, Index, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -18,8 +18,8 @@ class User(Base):
 
 # table for profile data
 class Profile(Base):
-    wwuid = Column(String(7), ForeignKey('users.wwuid'), nullable=False)
-    username = Column(String(250))
+    wwuid = Column(String(7), ForeignKey('users.wwuid'), nullable=False, index=True)
+    username = Column(String(250), index=True)
     full_name = Column(String(250))
     photo = Column(String(250))
     gender = Column(String(250))
@@ -46,22 +46,29 @@ class Profile(Base):
     favorite_music = Column(String(1000))
     pet_peeves = Column(String(500))
     personality = Column(String(250))
-    views = relationship("ProfileView", backref="profile", lazy="joined")
+    views = relationship("ProfileView", backref="profile")
+    # the total of views' num_views, kept up to date by update_views() in mask.py
+    # `python migrate.py --rebuild_view_counts` recounts it from scratch
+    view_count = Column(Integer, nullable=False, default=0, server_default='0')
     privacy = Column(Integer)
     department = Column(String(250))
     office = Column(String(250))
     office_hours = Column(String(250))
 
     def num_views(self):
-        count = 0
-        for view in self.views:
-            count += view.num_views
-        return count
+        return self.view_count or 0
+
+    BASE_INFO_FIELDS = ['username', 'full_name', 'photo', 'email', 'views']
+    VIEW_OTHER_FIELDS = ['username', 'full_name', 'photo', 'gender', 'birthday', 'email', 'phone', 'website', 'majors',
+                         'minors', 'graduate', 'preprofessional', 'class_standing', 'high_school', 'class_of',
+                         'relationship_status', 'attached_to', 'quote', 'quote_author', 'hobbies', 'career_goals',
+                         'favorite_books', 'favorite_movies', 'favorite_music', 'pet_peeves', 'personality', 'views',
+                         'privacy', 'department', 'office', 'office_hours']
 
     # sometimes useful to only get a small amount of information about a user
     # e.g. listing ALL of the profiles in a cache for faster search later
     def base_info(self):
-        return self.to_json(limitList=['username', 'full_name', 'photo', 'email', 'views'])
+        return self.to_json(limitList=self.BASE_INFO_FIELDS)
     # TODO: remove email from base_info
 
     def no_info(self):
@@ -75,16 +82,51 @@ class Profile(Base):
                                        'privacy', 'department', 'office', 'office_hours'])
 
     def view_other(self):
-        return self.to_json(limitList=['username', 'full_name', 'photo', 'gender', 'birthday', 'email', 'phone',
-                                       'website', 'majors', 'minors', 'graduate', 'preprofessional', 'class_standing',
-                                       'high_school', 'class_of', 'relationship_status', 'attached_to', 'quote',
-                                       'quote_author', 'hobbies', 'career_goals', 'favorite_books', 'favorite_movies',
-                                       'favorite_music', 'pet_peeves', 'personality', 'views', 'privacy',
-                                       'department', 'office', 'office_hours'])
+        return self.to_json(limitList=self.VIEW_OTHER_FIELDS)
 
 
 class ProfileView(Base):
+    __table_args__ = (Index('ix_profileviews_viewer_viewed', 'viewer', 'viewed'),)
     viewer = Column(String(75), ForeignKey('users.username'), nullable=False)
     viewed = Column(String(75), ForeignKey('profiles.username'), nullable=False)
     last_viewed = Column(DateTime)
     num_views = Column(Integer, default=0)
+
+
+# every counted profile view, only ever appended to (see view_tracker)
+class ProfileViewEvent(Base):
+    viewer = Column(String(75), nullable=False)
+    viewed = Column(String(75), nullable=False)
+    viewed_at = Column(DateTime, nullable=False)
+
+
+# the same views added up per profile and hour (hour is when it starts) and per profile and day
+# kept up to date along with the events, so the view stats never have to go through the events themselves
+class ProfileViewHour(Base):
+    __table_args__ = (Index('ix_profileviewhours_viewed_hour', 'viewed', 'hour', unique=True),
+                      Index('ix_profileviewhours_hour', 'hour'))
+    viewed = Column(String(75), nullable=False)
+    hour = Column(DateTime, nullable=False)
+    views = Column(Integer, nullable=False, default=0)
+
+
+class ProfileViewDay(Base):
+    __table_args__ = (Index('ix_profileviewdays_viewed_day', 'viewed', 'day', unique=True),
+                      Index('ix_profileviewdays_day', 'day'))
+    viewed = Column(String(75), nullable=False)
+    day = Column(Date, nullable=False)
+    views = Column(Integer, nullable=False, default=0)
+
+
+# a counter for each table that goes up whenever it's written to (see alchemy.py)
+# so caches built from a table can tell when they're out of date, even across processes
+class TableVersion(Base):
+    name = Column(String(250), unique=True, nullable=False)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# the last time (a unix timestamp) each user's cached identity and token claims were revoked
+# so every process can pick up what the others revoked (see revocations.py)
+class Revocation(Base):
+    wwuid = Column(String(7), unique=True, nullable=False)
+    revoked_at = Column(Float, nullable=False, index=True)
@@ -11,7 +11,7 @@ Base = declarative_base(cls=base.Base)
 # an unfortunately large table to hold the volunteer information
 # NOTE: this should and could probably be stored as a JSON blob
 class Volunteer(Base):
-    wwuid = Column(String(7), ForeignKey('users.wwuid'), nullable=False)
+    wwuid = Column(String(7), ForeignKey('users.wwuid'), nullable=False, index=True)
     campus_ministries = Column(Boolean, default=False)
     student_missions = Column(Boolean, default=False)
     aswwu = Column(Boolean, default=False)
@@ -0,0 +1,128 @@
+# name_index.py
+
+# in-memory trigram indexes over the usernames and full names of every profile, one per year
+# they answer the search box's "somewhere in the name" queries without scanning the profiles table:
+# the trigrams of the query narrow things down to a few candidates, which are then checked for real
+# built and kept fresh by year_maps.py, searches fall back to SQL until a year's index is ready
+
+import re
+import threading
+
+from tornado.options import define, options
+
+import src.aswwu.alchemy as alchemy
+import src.aswwu.year_maps as year_maps
+
+define("name_index_poll_interval", default=2,
+       help="seconds between checks for names other processes have changed, which rebuild the current year's index")
+
+
+def trigrams(value):
+    return set(value[i:i + 3] for i in range(len(value) - 2))
+
+
+class TrigramIndex:
+    def __init__(self):
+        # profile id -> (username, full_name), both lower case
+        self.names = {}
+        # trigram -> ids of the profiles with it in their username or full name
+        self.postings = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    # replace=False leaves profiles that are already indexed alone (see build())
+    def add(self, key, username, full_name, replace=True):
+        names = ((username or u'').lower(), (full_name or u'').lower())
+        with self.lock:
+            if key in self.names:
+                if not replace:
+                    return
+                self._remove(key)
+            self.names[key] = names
+            for trigram in trigrams(names[0]) | trigrams(names[1]):
+                self.postings.setdefault(trigram, set()).add(key)
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        names = self.names.pop(key, None)
+        if names is None:
+            return
+        for trigram in trigrams(names[0]) | trigrams(names[1]):
+            postings = self.postings.get(trigram)
+            if postings is not None:
+                postings.discard(key)
+                if not postings:
+                    del self.postings[trigram]
+
+    # the ids of every profile matching a search term the same way as
+    # `username ilike '%jo%sm%' or full_name ilike '%jo%sm%'` does for "jo sm" (or "jo.sm")
+    # as {id: score}, lower scores are better matches
+    def search(self, term):
+        pieces = [piece for piece in re.split(r"[ .]", term.lower()) if piece]
+        pattern = re.compile(".*".join(re.escape(piece) for piece in pieces))
+        needed = set()
+        for piece in pieces:
+            needed |= trigrams(piece)
+        with self.lock:
+            if needed:
+                # rarest trigram first so the candidate set shrinks as fast as possible
+                postings = sorted((self.postings.get(trigram, set()) for trigram in needed), key=len)
+                candidates = set(postings[0])
+                for posting in postings[1:]:
+                    candidates &= posting
+                    if not candidates:
+                        break
+            else:
+                # nothing three letters long to go on, so check everyone (still no SQL)
+                candidates = self.names.keys()
+            matches = {}
+            for key in candidates:
+                scores = [score for score in (score_match(pattern, name) for name in self.names[key])
+                          if score is not None]
+                if scores:
+                    matches[key] = min(scores)
+        return matches
+
+
+# 0 if the name starts with the match, 1 if a word in it does, 2 for anywhere else and None for no match
+def score_match(pattern, name):
+    match = pattern.search(name)
+    if match is None:
+        return None
+    if match.start() == 0:
+        return 0
+    if name[match.start() - 1] in u" .-'":
+        return 1
+    return 2
+
+
+def _fill(index, model, session):
+    for key, username, full_name in session.query(model.id, model.username, model.full_name).yield_per(1000):
+        index.add(key, username, full_name, replace=False)
+
+
+def _update(index, profile):
+    index.add(profile.id, profile.username, profile.full_name)
+
+
+_indexes = year_maps.YearMaps("name_index", alchemy.NAMES_TAG, TrigramIndex, _fill, _update)
+
+
+# a year's index, None until it has been built
+def get_index(year):
+    return _indexes.get(year)
+
+
+# call it from the IOLoop, in each process that serves requests
+def start():
+    _indexes.start(options.name_index_poll_interval)
+
+
+# call this whenever a current year profile is created or its names change
+def update_profile(profile):
+    _indexes.update_profile(profile)
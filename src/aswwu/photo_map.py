@@ -0,0 +1,86 @@
+# photo_map.py
+
+# every profile's photo, per year, by wwuid and by username
+# so the photo redirects (one per <img> on a directory page) don't need the database
+# a miss only means the profile wasn't there when the map was built, so lookups check those with SQL
+# built and kept fresh by year_maps.py, lookups fall back to SQL until a year's map is ready
+
+import threading
+
+from tornado.options import define, options
+
+import src.aswwu.alchemy as alchemy
+import src.aswwu.year_maps as year_maps
+
+define("photo_map_poll_interval", default=2,
+       help="seconds between checks for photos other processes have changed, which rebuild the current year's map")
+
+# what lookup() gives for a wwuid or username more than one profile has, the database has to sort those out
+AMBIGUOUS = object()
+
+
+class PhotoMap:
+    def __init__(self):
+        # wwuid/username -> (profile id, photo), or AMBIGUOUS
+        self.by_wwuid = {}
+        self.by_username = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.by_wwuid)
+
+    # replace=False leaves profiles that are already there alone (see build())
+    # wwuids are kept as strings, the archives store them as integers but requests always look them up as text
+    def add(self, key, wwuid, username, photo, replace=True):
+        with self.lock:
+            for entries, name in ((self.by_wwuid, _wwuid_key(wwuid)), (self.by_username, username)):
+                if name is None:
+                    continue
+                entry = entries.get(name)
+                if entry is None or (entry is not AMBIGUOUS and entry[0] == key and replace):
+                    entries[name] = (key, photo)
+                elif entry is not AMBIGUOUS and entry[0] != key:
+                    entries[name] = AMBIGUOUS
+
+    # (found, photo) for a wwuid or username, found is False if there's no such profile (in the map)
+    # returns AMBIGUOUS if there's more than one
+    def lookup(self, wwuid=None, username=None):
+        entries, name = (self.by_wwuid, _wwuid_key(wwuid)) if wwuid is not None else (self.by_username, username)
+        entry = entries.get(name)
+        if entry is AMBIGUOUS:
+            return AMBIGUOUS
+        if entry is None:
+            return False, None
+        return True, entry[1]
+
+
+def _wwuid_key(wwuid):
+    return str(wwuid) if wwuid is not None else None
+
+
+def _fill(photos, model, session):
+    for key, wwuid, username, photo in session.query(model.id, model.wwuid, model.username, model.photo)\
+            .yield_per(1000):
+        photos.add(key, wwuid, username, photo, replace=False)
+
+
+def _update(photos, profile):
+    photos.add(profile.id, profile.wwuid, profile.username, profile.photo)
+
+
+_maps = year_maps.YearMaps("photo_map", alchemy.PHOTOS_TAG, PhotoMap, _fill, _update)
+
+
+# a year's map, None until it has been built
+def get_map(year):
+    return _maps.get(year)
+
+
+# call it from the IOLoop, in each process that serves requests
+def start():
+    _maps.start(options.photo_map_poll_interval)
+
+
+# call this whenever a current year profile is created or its photo changes
+def update_profile(profile):
+    _maps.update_profile(profile)
@@ -0,0 +1,86 @@
+# revocations.py
+
+# caching.invalidate_user() only reaches the caches of the process that calls it
+# so revoke() also writes the revocation to the revocations table, and every process reads the new ones
+# every revocation_poll_interval seconds and applies them to its own caches
+# that's how long another worker can go on trusting a changed user's cached roles or token claims
+
+import logging
+import time
+
+import tornado.ioloop
+from sqlalchemy import select
+from tornado.options import define, options
+
+import src.aswwu.alchemy as alchemy
+import src.aswwu.async_alchemy as async_alchemy
+import src.aswwu.caching as caching
+import src.aswwu.models.mask as mask_model
+from src.aswwu.models.bases import uuid_gen
+
+logger = logging.getLogger("aswwu")
+
+define("revocation_poll_interval", default=2,
+       help="seconds between checks for users whose cached identity other processes have revoked")
+
+# how far back each check reaches before the last one, for revocations committed a little after they were made
+POLL_SLACK = 5
+
+
+# rows older than this can't matter anymore, the caches would have let go of them by now
+def keep_for():
+    return max(options.identity_cache_ttl, options.token_claims_ttl) + POLL_SLACK
+
+
+# call this whenever a user's name, photo, roles or status change, once the change has been committed
+def revoke(wwuid):
+    now = time.time()
+    caching.invalidate_user(wwuid, now)
+    revocations = mask_model.Revocation.__table__
+    try:
+        with alchemy.get_engine('people').begin() as connection:
+            connection.execute(revocations.insert().prefix_with("OR IGNORE")
+                               .values(id=uuid_gen(), wwuid=str(wwuid), revoked_at=now))
+            connection.execute(revocations.update().where(revocations.c.wwuid == str(wwuid))
+                               .values(revoked_at=now))
+            connection.execute(revocations.delete().where(revocations.c.revoked_at < now - keep_for()))
+    except Exception as e:
+        logger.info("revocations: couldn't record " + str(wwuid) + ": " + str(e))
+
+
+# when the last check started, None before the first one (which reads everything still in the table)
+_last_poll = None
+
+
+# applies what other processes have revoked since the last check
+# runs on the database threads, see start()
+def poll():
+    global _last_poll
+    started = time.time()
+    revocations = mask_model.Revocation.__table__
+    query = select([revocations.c.wwuid, revocations.c.revoked_at])
+    if _last_poll is not None:
+        query = query.where(revocations.c.revoked_at >= _last_poll - POLL_SLACK)
+    try:
+        rows = alchemy.get_engine('people', readonly=True).execute(query).fetchall()
+    except Exception as e:
+        logger.info("revocations: couldn't check: " + str(e))
+        return
+    for wwuid, revoked_at in rows:
+        caching.invalidate_user(wwuid, revoked_at)
+    _last_poll = started
+
+
+_poller = None
+
+
+# call it from the IOLoop, in each process that serves requests
+def start():
+    global _poller
+    async_alchemy.run(poll)
+    if _poller is not None:
+        _poller.stop()
+    if options.revocation_poll_interval > 0:
+        _poller = tornado.ioloop.PeriodicCallback(lambda: async_alchemy.run(poll),
+                                                  options.revocation_poll_interval * 1000)
+        _poller.start()
@@ -4,33 +4,34 @@ import logging
 import bleach
 import tornado.web
 
-from src.aswwu.base_handlers import BaseHandler
+from src.aswwu.base_handlers import BaseHandler, cached_response
 import src.aswwu.models.ask_anything as ask_anything_model
 import src.aswwu.alchemy as alchemy
 
 logger = logging.getLogger("aswwu")
 
-people_db = alchemy.people_db
-
 
 class AskAnythingAddHandler(BaseHandler):
     @tornado.web.authenticated
     def post(self):
         ask_anything = ask_anything_model.AskAnything()
         ask_anything.question = bleach.clean(self.get_argument("question"))
-        alchemy.add_or_update(ask_anything)
+        alchemy.add_or_update(ask_anything, self.people_db)
         self.set_status(201)
         self.write({"status": "Question Submitted"})
 
 
 class AskAnythingViewAllHandler(BaseHandler):
+    # logged in users see which questions they've voted for, so only the anonymous version is cached
+    @cached_response(lambda handler: None if handler.current_user else "anonymous",
+                     tags=['askanythings', 'askanythingvotes'])
     def get(self):
-        results = people_db.query(ask_anything_model.AskAnything).filter_by(authorized=True, reviewed=True)
+        results = self.people_db.query(ask_anything_model.AskAnything).filter_by(authorized=True, reviewed=True)
         to_return = []
         user = self.get_current_user()
         questions_voted = {}
         if user:
-            votes = people_db.query(ask_anything_model.AskAnythingVote).filter_by(voter=user.username).all()
+            votes = self.people_db.query(ask_anything_model.AskAnythingVote).filter_by(voter=user.username).all()
             questions_voted = {}
             for vote in votes:
                 questions_voted[vote.question_id] = True
@@ -46,7 +47,7 @@ class AskAnythingRejectedHandler(BaseHandler):
     def get(self):
         user = self.current_user
         if 'askanything' in user.roles or 'administrator' in user.roles:
-            results = people_db.query(ask_anything_model.AskAnything).filter_by(authorized=False, reviewed=True)
+            results = self.people_db.query(ask_anything_model.AskAnything).filter_by(authorized=False, reviewed=True)
             to_return = []
             for question in results:
                 to_return.append(question.serialize())
@@ -60,19 +61,19 @@ class AskAnythingVoteHandler(BaseHandler):
     @tornado.web.authenticated
     def post(self, q_id):
         user = self.current_user
-        votes = people_db.query(ask_anything_model.AskAnythingVote)\
+        votes = self.people_db.query(ask_anything_model.AskAnythingVote)\
             .filter_by(question_id=q_id, voter=user.username).all()
         # question = s.query(AskAnythingVote).filter_by(id=q_id).one()
         if len(votes) > 0:
             for vote in votes:
-                alchemy.delete_thing(vote)
+                alchemy.delete_thing(vote, self.people_db)
             self.set_status(200)
             self.write({"Status": "Success. Vote Removed."})
         else:
             vote = ask_anything_model.AskAnythingVote()
             vote.question_id = q_id
             vote.voter = user.username
-            alchemy.add_or_update(vote)
+            alchemy.add_or_update(vote, self.people_db)
             self.set_status(200)
             self.write({"status": "Success. Vote Added"})
 
@@ -82,7 +83,7 @@ class AskAnythingAuthorizeHandler(BaseHandler):
     def get(self):
         user = self.current_user
         if 'askanything' in user.roles or 'administrator' in user.roles:
-            results = people_db.query(ask_anything_model.AskAnything).filter_by(reviewed=False)
+            results = self.people_db.query(ask_anything_model.AskAnything).filter_by(reviewed=False)
             to_return = []
             for question in results:
                 to_return.append(question.serialize())
@@ -96,10 +97,10 @@ class AskAnythingAuthorizeHandler(BaseHandler):
         user = self.current_user
         authorized = self.get_argument("authorize").upper() == "Y"
         if 'askanything' in user.roles or 'administrator' in user.roles:
-            ask_anything = people_db.query(ask_anything_model.AskAnything).filter_by(id=question_id).one()
+            ask_anything = self.people_db.query(ask_anything_model.AskAnything).filter_by(id=question_id).one()
             ask_anything.authorized = authorized
             ask_anything.reviewed = True
-            alchemy.add_or_update(ask_anything)
+            alchemy.add_or_update(ask_anything, self.people_db)
             self.set_status(200)
             self.write({"status": "Success"})
         else:
@@ -1,21 +1,27 @@
 import logging
 
+import tornado.gen
 import tornado.web
 
-from src.aswwu.base_handlers import BaseHandler
+from src.aswwu.base_handlers import BaseHandler, cached_response
 import src.aswwu.alchemy as alchemy
 import src.aswwu.models.elections as election_model
 
 logger = logging.getLogger("aswwu")
 
-election_db = alchemy.election_db
-
 
 # get all of the profiles in our database
 class AllElectionVoteHandler(BaseHandler):
+    @cached_response(lambda handler: "all", tags=['elections'])
+    @tornado.gen.coroutine
     def get(self):
-        votes = alchemy.query_all_election(election_model.Election)
-        self.write({'results': [v.info() for v in votes]})
+        yield self.write_json_stream('results', votes_info_batch)
+
+
+# runs on the database threads, see async_alchemy and BaseHandler.write_json_stream
+def votes_info_batch(after, size):
+    votes, after = alchemy.query_batch(alchemy.election_db, election_model.Election, after, size)
+    return [v.info() for v in votes], after
 
 
 # update user's vote
@@ -24,13 +30,13 @@ class ElectionVoteHandler(BaseHandler):
     def post(self, username):
         user = self.current_user
         if user.username == username or 'administrator' in user.roles:
-            usrvote = alchemy.query_by_wwuid_election(election_model.Election, str(user.wwuid))
+            usrvote = alchemy.query_by_wwuid_election(election_model.Election, str(user.wwuid), self.election_db)
             # Fix this to be more efficient
             if len(usrvote) == 0:
                 new_vote = election_model.Election(wwuid=str(user.wwuid))
-                vote = alchemy.add_or_update_election(new_vote)
+                vote = alchemy.add_or_update_election(new_vote, self.election_db)
             else:
-                vote = election_db.query(election_model.Election).filter_by(wwuid=str(user.wwuid)).one()
+                vote = self.election_db.query(election_model.Election).filter_by(wwuid=str(user.wwuid)).one()
             vote.candidate_one = self.get_argument('candidate_one', '')
             vote.candidate_two = self.get_argument('candidate_two', '')
             vote.sm_one = self.get_argument('sm_one', '')
@@ -38,7 +44,7 @@ class ElectionVoteHandler(BaseHandler):
             vote.new_department = self.get_argument('new_department', '')
             vote.district = self.get_argument('district', '')
 
-            alchemy.add_or_update_election(vote)
+            alchemy.add_or_update_election(vote, self.election_db)
 
             self.write({'vote': 'successfully voted'})
         else:
@@ -47,5 +53,5 @@ class ElectionVoteHandler(BaseHandler):
 
 class ElectionLiveFeedHandler(BaseHandler):
     def get(self):
-        votes = alchemy.query_all_election(election_model.Election)
+        votes = alchemy.query_all_election(election_model.Election, self.election_db)
         self.write({'size': len(votes)})
@@ -4,9 +4,10 @@ import logging
 import os
 
 import bleach
+import tornado.gen
 import tornado.web
 
-from src.aswwu.base_handlers import BaseHandler
+from src.aswwu.base_handlers import BaseHandler, cached_response
 import src.aswwu.models.forms as forms_model
 import src.aswwu.alchemy as alchemy
 
@@ -28,15 +29,15 @@ class NewFormHandler(BaseHandler):
                 form.department = bleach.clean(self.get_argument('department'))
                 form.owner = bleach.clean(self.get_argument('owner'))
                 form.image = bleach.clean(self.get_argument('image'))
-                alchemy.add_or_update_form(form)
-                form = alchemy.jobs_db.query(forms_model.JobForm).filter_by(job_name=str(form.job_name)).one()
+                alchemy.add_or_update_form(form, self.jobs_db)
+                form = self.jobs_db.query(forms_model.JobForm).filter_by(job_name=str(form.job_name)).one()
                 questions = json.loads(self.get_argument('questions'))
                 for q in questions:
                     if 'question' in q:
                         question = forms_model.JobQuestion()
                         question.question = q['question']
                         question.jobID = form.id
-                        alchemy.add_or_update_form(question)
+                        alchemy.add_or_update_form(question, self.jobs_db)
                 self.set_status(201)
                 self.write({"status": "submitted"})
             else:
@@ -44,19 +45,21 @@ class NewFormHandler(BaseHandler):
                 self.write({"status": "Unauthorized"})
         except Exception as e:
             logger.error("NewFormHandler: error.\n" + str(e.message))
-            alchemy.jobs_db.rollback()
+            self.jobs_db.rollback()
             self.set_status(500)
             self.write({"status": "Error"})
 
 
 class ViewFormHandler(BaseHandler):
+    # the list of every form is the same for everyone, single forms aren't cached
+    @cached_response(lambda handler, job_id: job_id if job_id == "all" else None, tags=['jobforms'])
     def get(self, job_id):
         try:
             if job_id == "all":
-                forms = alchemy.query_all_forms(forms_model.JobForm)
+                forms = alchemy.query_all_forms(forms_model.JobForm, self.jobs_db)
                 self.write({'forms': [f.min() for f in forms]})
             else:
-                form = alchemy.jobs_db.query(forms_model.JobForm).filter_by(id=str(job_id)).one()
+                form = self.jobs_db.query(forms_model.JobForm).filter_by(id=str(job_id)).one()
                 self.write({'form': form.serialize()})
         #         TODO: exception handle
         except Exception as e:
@@ -71,11 +74,11 @@ class DeleteFormHandler(BaseHandler):
         try:
             user = self.current_user
             if 'forms-admin' in user.roles:
-                form = alchemy.jobs_db.query(forms_model.JobForm).filter_by(id=self.get_argument("jobID")).one()
+                form = self.jobs_db.query(forms_model.JobForm).filter_by(id=self.get_argument("jobID")).one()
                 for q in form.questions:
-                    alchemy.delete_thing_forms(alchemy.jobs_db.query(forms_model.JobQuestion)
-                                               .filter_by(id=int(q.id)).one())
-                alchemy.delete_thing_forms(form)
+                    alchemy.delete_thing_forms(self.jobs_db.query(forms_model.JobQuestion)
+                                               .filter_by(id=int(q.id)).one(), self.jobs_db)
+                alchemy.delete_thing_forms(form, self.jobs_db)
                 self.set_status(200)
                 self.write({"status": "Form Deleted"})
             else:
@@ -84,7 +87,7 @@ class DeleteFormHandler(BaseHandler):
         except Exception as e:
             logger.error("DeleteFormHandler: error.\n" + str(e.message))
             self.set_status(500)
-            alchemy.jobs_db.rollback()
+            self.jobs_db.rollback()
             self.write({"status": "Error"})
 
 
@@ -99,21 +102,21 @@ class SubmitApplicationHandler(BaseHandler):
                 if len(answers) > 50:
                     raise ValueError("Too many answers submitted")
                 try:
-                    app = alchemy.jobs_db.query(forms_model.JobApplication).filter_by(jobID=self.get_argument("jobID"),
-                                                                                      username=user.username).one()
+                    app = self.jobs_db.query(forms_model.JobApplication).filter_by(jobID=self.get_argument("jobID"),
+                                                                                   username=user.username).one()
                 except:
                     temp_var = True
                     app = forms_model.JobApplication()
                     app.status = "new"
                 app.jobID = bleach.clean(self.get_argument('jobID'))
                 app.username = user.username
-                alchemy.add_or_update_form(app)
+                alchemy.add_or_update_form(app, self.jobs_db)
                 if temp_var:
-                    app = alchemy.jobs_db.query(forms_model.JobApplication).filter_by(jobID=self.get_argument("jobID"),
-                                                                                      username=user.username).one()
+                    app = self.jobs_db.query(forms_model.JobApplication).filter_by(jobID=self.get_argument("jobID"),
+                                                                                   username=user.username).one()
                 for a in answers:
                     try:
-                        answer = alchemy.jobs_db.query(forms_model.JobAnswer)\
+                        answer = self.jobs_db.query(forms_model.JobAnswer)\
                             .filter_by(applicationID=app.id, questionID=a['questionID']).one()
                     except:
                         answer = forms_model.JobAnswer()
@@ -121,7 +124,7 @@ class SubmitApplicationHandler(BaseHandler):
                         answer.questionID = bleach.clean(a['questionID'])
                         answer.answer = bleach.clean(a['answer'])
                         answer.applicationID = app.id
-                        alchemy.add_or_update_form(answer)
+                        alchemy.add_or_update_form(answer, self.jobs_db)
                 self.set_status(201)
                 self.write({"status": "submitted"})
             else:
@@ -129,50 +132,59 @@ class SubmitApplicationHandler(BaseHandler):
                 self.write({"status": "Unauthorized"})
         except Exception as e:
             logger.error("SubmitApplicationHandler: error.\n" + str(e.message))
-            alchemy.jobs_db.rollback()
+            self.jobs_db.rollback()
             self.set_status(500)
             self.write({"status": "Error"})
 
 
 class ViewApplicationHandler(BaseHandler):
     @tornado.web.authenticated
+    @tornado.gen.coroutine
     def get(self, job_id, username):
         try:
             user = self.current_user
             if job_id == "all" and username == "all":
                 if 'forms-admin' in user.roles:
-                    apps = alchemy.query_all_forms(forms_model.JobApplication)
-                    self.write({'applications': [a.min() for a in apps]})
+                    yield self.write_json_stream('applications', application_min_batch)
             elif job_id == "all" and username != "all":
                 if 'forms-admin' in user.roles or username == user.username:
-                    apps = alchemy.jobs_db.query(forms_model.JobApplication).filter_by(username=username)
+                    apps = self.jobs_db.query(forms_model.JobApplication).filter_by(username=username)
                     self.write({'applications': [a.min() for a in apps]})
             elif username == "all" and job_id != "all":
                 if 'forms-admin' in user.roles:
-                    apps = alchemy.jobs_db.query(forms_model.JobApplication).filter_by(jobID=job_id)
+                    apps = self.jobs_db.query(forms_model.JobApplication).filter_by(jobID=job_id)
                     self.write({'applications': [a.min() for a in apps]})
             else:
                 if 'forms-admin' in user.roles or username == user.username:
-                    app = alchemy.jobs_db.query(forms_model.JobApplication)\
+                    app = self.jobs_db.query(forms_model.JobApplication)\
                         .filter_by(jobID=str(job_id), username=username).one()
                     self.write({'application': app.serialize()})
         #             TODO: Exception Handle
         except Exception as e:
             logger.error("ViewApplicationHandler: error.\n" + str(e.message))
+            if self._headers_written:
+                # part of a streamed listing already went out, see write_json_stream
+                raise
             self.set_status(404)
             self.write({"status": "Application not found"})
 
 
+# runs on the database threads, see async_alchemy and BaseHandler.write_json_stream
+def application_min_batch(after, size):
+    apps, after = alchemy.query_batch(alchemy.jobs_db, forms_model.JobApplication, after, size)
+    return [a.min() for a in apps], after
+
+
 class ApplicationStatusHandler(BaseHandler):
     @tornado.web.authenticated
     def post(self):
         try:
             user = self.current_user
             if 'forms' in user.roles:
-                app = alchemy.jobs_db.query(forms_model.JobApplication)\
+                app = self.jobs_db.query(forms_model.JobApplication)\
                     .filter_by(jobID=str(self.get_argument("jobID")), username=self.get_argument("username")).one()
                 app.status = bleach.clean(self.get_argument("status"))
-                alchemy.add_or_update_form(app)
+                alchemy.add_or_update_form(app, self.jobs_db)
                 self.set_status(200)
                 self.write({"status": "success"})
             else:
@@ -180,7 +192,7 @@ class ApplicationStatusHandler(BaseHandler):
                 self.write({"status": "Unauthorized"})
         except Exception as e:
             logger.error("ApplicationStatusHandler: error.\n" + str(e.message))
-            alchemy.jobs_db.rollback()
+            self.jobs_db.rollback()
             self.set_status(500)
             self.write({"status": "Error"})
 
@@ -192,7 +204,7 @@ class ResumeUploadHandler(BaseHandler):
         try:
             job_id = self.get_argument("jobID")
             try:
-                alchemy.jobs_db.query(forms_model.JobForm).filter_by(id=job_id).one()
+                self.jobs_db.query(forms_model.JobForm).filter_by(id=job_id).one()
             except:
                 self.set_status(404)
                 self.write({"status": "Error", "message": "Job doesn't exist"})
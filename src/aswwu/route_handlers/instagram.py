@@ -2,13 +2,15 @@ import logging
 
 from tornado.httpclient import HTTPClient
 
-from src.aswwu.base_handlers import BaseHandler
+from src.aswwu.base_handlers import BaseHandler, cached_response
 
 logger = logging.getLogger("aswwu")
 
 
 # This is the instagram handler for the atlas (I did this to hide the access token).
 class FeedHandler(BaseHandler):
+    # nothing we store changes these, they're only cached so we don't ask instagram/issuu on every request
+    @cached_response(lambda handler: handler.get_argument('name', ''), ttl=300)
     def get(self):
         name = self.get_argument('name', '')
         if name == "atlas":
@@ -1,18 +1,31 @@
-import datetime
-import json
 import logging
 
 import bleach
+import six
+import tornado.escape
+import tornado.gen
 import tornado.web
-from sqlalchemy import or_
+from sqlalchemy import and_, func, or_
+from sqlalchemy.exc import OperationalError
 
-from src.aswwu.base_handlers import BaseHandler
+from src.aswwu.base_handlers import BaseHandler, cached_response
 import src.aswwu.models.mask as mask_model
 import src.aswwu.archive_models as archives
 import src.aswwu.alchemy as alchemy
+import src.aswwu.async_alchemy as async_alchemy
+import src.aswwu.caching as caching
+import src.aswwu.name_index as name_index
+import src.aswwu.photo_map as photo_map
+import src.aswwu.revocations as revocations
+import src.aswwu.search_index as search_index
+import src.aswwu.view_tracker as view_tracker
+import src.aswwu.year_maps as year_maps
 
 logger = logging.getLogger("aswwu")
 
+# number of ids from the name index looked up per query
+SEARCH_CHUNK_SIZE = 500
+
 
 # administrative role handler
 class AdministratorRoleHandler(BaseHandler):
@@ -30,7 +43,7 @@ class AdministratorRoleHandler(BaseHandler):
             # sharing is caring
             if cmd == 'set_role':
                 username = self.get_argument('username', '').replace(' ', '.').lower()
-                fuser = alchemy.people_db.query(mask_model.User).filter_by(username=username).all()
+                fuser = self.people_db.query(mask_model.User).filter_by(username=username).all()
                 if not fuser:
                     self.write({'error': 'user does not exist'})
                 else:
@@ -43,50 +56,350 @@ class AdministratorRoleHandler(BaseHandler):
                     roles.append(self.get_argument('newRole', None))
                     roles = set(roles)
                     fuser.roles = ', '.join(roles)
-                    alchemy.add_or_update(fuser)
+                    alchemy.add_or_update(fuser, self.people_db)
+                    revocations.revoke(fuser.wwuid)
                     self.write({'response': 'success'})
 
 
 # this is the root of all searches
 class SearchHandler(BaseHandler):
     # accepts a year and a query as parameters
+    @tornado.gen.coroutine
     def get(self, year, query):
-        # if searching in the current year, access the Profile model
-        if year == self.application.options.current_year:
-            model = mask_model.Profile
-            results = alchemy.people_db.query(model)
-        # otherwise we're going old school with the Archives
+        try:
+            listing = listing_arguments(self, mask_model.Profile.BASE_INFO_FIELDS)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({'error': str(e)})
+            return
+        if listing is None:
+            results = yield async_alchemy.run(search, year, query)
+            self.write({'results': results})
+        else:
+            results, cursor = yield async_alchemy.run(search_listing, year, query, listing)
+            self.write(listing_response('results', results, cursor, listing))
+
+
+# runs on the database threads, see async_alchemy
+def search(year, query):
+    return [r.base_info() for r in search_profiles(year, query)]
+
+
+# the profiles from a year matching a query, best matches first
+def search_profiles(year, query):
+    model, results, name_scores = search_query(year, query)
+    if name_scores is None:
+        return results.all()
+    # look up the matching ids a chunk at a time (SQLite limits how many parameters a query can have)
+    # then put the best name matches first, the sort is stable so ties keep the FTS5 ranking
+    rows = []
+    for ids in id_chunks(name_scores):
+        rows.extend(results.filter(model.id.in_(ids)))
+    rows.sort(key=lambda r: name_scores[r.id])
+    return rows
+
+
+# search() for a listing (see listing_arguments)
+def search_listing(year, query, listing):
+    model, results, name_scores = search_query(year, query)
+    fields = listing['fields'] or model.BASE_INFO_FIELDS
+    if name_scores is None:
+        return listing_page(listing_query(results, model, fields, listing).all(), model, fields, listing)
+    # every chunk brings back its own first page, together they hold the first page of the lot
+    rows = []
+    for ids in id_chunks(name_scores):
+        rows.extend(listing_query(results.filter(model.id.in_(ids)), model, fields, listing))
+    if listing['order_by']:
+        rows.sort(key=listing_key(listing))
+    else:
+        rows.sort(key=lambda r: name_scores[r.id])
+    return listing_page(rows, model, fields, listing)
+
+
+def id_chunks(name_scores):
+    ids = list(name_scores)
+    return [ids[i:i + SEARCH_CHUNK_SIZE] for i in range(0, len(ids), SEARCH_CHUNK_SIZE)]
+
+
+# works out what a search is for
+# returns (model, query, name_scores), where the query has every filter except the name terms
+# answered by the name index, name_scores is those terms' {id: score} (None if there weren't any)
+def search_query(year, query):
+    # if searching in the current year, access the Profile model
+    if year == tornado.options.options.current_year:
+        model = mask_model.Profile
+        results = alchemy.people_db.query(model)
+    # otherwise we're going old school with the Archives
+    else:
+        model = archives.get_archive_model(year)
+        results = alchemy.archive_db.query(model)
+
+    # name terms are answered by the year's in-memory name index once it's built (see name_index.py)
+    # until then, they and field=value terms on indexed columns go to the table's FTS5 index
+    # if it has one (see search_index.py), and everything else falls back to ilike
+    names = name_index.get_index(year)
+    indexed = search_index.indexed_columns(results.session, model.__tablename__)
+    matches = []
+    # {id: score} of the profiles matching every name term so far, None if there haven't been any
+    name_scores = None
+
+    # break up the query <-- expected to be a standard URIEncodedComponent
+    fields = [q.split("=") for q in query.split(";")]
+    for f in fields:
+        if len(f) == 1:
+            if names is not None:
+                scores = names.search(f[0])
+                if name_scores is None:
+                    name_scores = scores
+                else:
+                    name_scores = dict((key, name_scores[key] + scores[key]) for key in name_scores if key in scores)
+                continue
+            match = search_index.name_match(f[0]) if indexed else None
+            if match:
+                # every word has to start a word in their username or full name, e.g. "jo sm" finds John Smith
+                matches.append(match)
+                continue
+            # throw %'s around everything to make the search relative
+            # e.g. searching for "b" will return anything that has b *somewhere* in it
+            v = '%'+f[0].replace(' ', '%').replace('.', '%')+'%'
+            results = results.filter(or_(model.username.ilike(v), model.full_name.ilike(v)))
         else:
-            model = archives.get_archive_model(year)
-            results = alchemy.archive_db.query(model)
-
-        # break up the query <-- expected to be a standard URIEncodedComponent
-        fields = [q.split("=") for q in query.split(";")]
-        for f in fields:
-            if len(f) == 1:
-                # throw %'s around everything to make the search relative
-                # e.g. searching for "b" will return anything that has b *somewhere* in it
-                v = '%'+f[0].replace(' ', '%').replace('.', '%')+'%'
-                results = results.filter(or_(model.username.ilike(v), model.full_name.ilike(v)))
+            # we want these queries to matche exactly
+            # e.g. "%male%" would also return "female"
+            if f[0] in ['gender']:
+                results = results.filter(getattr(model, f[0]).ilike(f[1]))
             else:
-                # we want these queries to matche exactly
-                # e.g. "%male%" would also return "female"
-                if f[0] in ['gender']:
-                    results = results.filter(getattr(model, f[0]).ilike(f[1]))
+                attribute_arr = f[1].encode('ascii', 'ignore').split(",")
+                match = search_index.column_match(f[0], attribute_arr) if f[0] in indexed else None
+                if match:
+                    matches.append(match)
+                elif len(attribute_arr) > 1:
+                    results = results.filter(or_(getattr(model, f[0]).ilike("%" + v + "%") for v in attribute_arr))
                 else:
-                    attribute_arr = f[1].encode('ascii', 'ignore').split(",")
-                    if len(attribute_arr) > 1:
-                        results = results.filter(or_(getattr(model, f[0]).ilike("%" + v + "%") for v in attribute_arr))
-                    else:
-                        results = results.filter(getattr(model, f[0]).ilike('%'+f[1]+'%'))
-        self.write({'results': [r.base_info() for r in results]})
+                    results = results.filter(getattr(model, f[0]).ilike('%'+f[1]+'%'))
+    if matches:
+        # best matches first
+        results = search_index.apply(results, model, matches)
+    return model, results, name_scores
+
+
+# searches this year and every archived year at once
+# each person only shows up once, for the newest year they match in, e.g. {..., 'year': '1516'}
+# results are ordered by username then year, `limit` gives a page of them and the returned cursor gets the next page
+class AllYearsSearchHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self, query):
+        try:
+            limit = self.get_argument('limit', None)
+            if limit is not None:
+                if not limit.isdigit() or int(limit) < 1:
+                    raise ValueError('limit must be a positive number')
+                limit = int(limit)
+            cursor = parse_year_cursor(self.get_argument('cursor', None))
+        except ValueError as e:
+            self.set_status(400)
+            self.write({'error': str(e)})
+            return
+        years = [tornado.options.options.current_year]
+        if alchemy.database_exists('archives'):
+            years += archives.ARCHIVE_YEARS
+        # each year only reads the page starting at the cursor's username
+        # the cursor's own username is read again, in case a newer year's profile hides an older one,
+        # so a page can need one more row from each year than the limit, plus one to tell if there's a next page
+        start = cursor[0] if cursor is not None else None
+        per_year = limit + 2 if limit is not None else None
+        # every year runs on the database threads at the same time
+        found = yield [async_alchemy.run(search_year, year, query, start, per_year) for year in years]
+        seen = set()
+        results = []
+        # years are newest first, so the first hit for a wwuid is the one to keep
+        for year, hits in zip(years, found):
+            for wwuid, info in hits:
+                if wwuid not in seen:
+                    seen.add(wwuid)
+                    info['year'] = year
+                    results.append(info)
+        results.sort(key=year_cursor_key)
+        if cursor is not None:
+            results = [r for r in results if year_cursor_key(r) > cursor]
+        next_cursor = None
+        if limit is not None and len(results) > limit:
+            results = results[:limit]
+            next_cursor = results[-1]['username'] + '|' + results[-1]['year']
+        self.write({'results': results, 'cursor': next_cursor})
+
+
+# runs on the database threads, see async_alchemy
+# returns (wwuid, base_info) pairs in username order, from `start` on and at most `limit` of them if they're given
+# a year with nothing to search (no archive model for it, or its table is missing from archives.db) has no hits
+# anything else going wrong is raised, so the request fails instead of leaving the year out
+def search_year(year, query, start=None, limit=None):
+    if year != tornado.options.options.current_year:
+        try:
+            archives.get_archive_model(year)
+        except ValueError as e:
+            logger.info("search_year: couldn't search " + year + ": " + str(e))
+            return []
+    try:
+        model, results, name_scores = search_query(year, query)
+        if start is not None:
+            results = results.filter(model.username >= start)
+        results = results.order_by(None).order_by(model.username)
+        if name_scores is None:
+            rows = results.limit(limit).all()
+        else:
+            # every chunk brings back its own first page, together they hold the first page of the lot
+            rows = []
+            for ids in id_chunks(name_scores):
+                rows.extend(results.filter(model.id.in_(ids)).limit(limit))
+            rows.sort(key=lambda r: r.username)
+            rows = rows[:limit]
+    except OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+        logger.info("search_year: couldn't search " + year + ": " + str(e))
+        return []
+    return [(str(r.wwuid), r.base_info()) for r in rows]
+
+
+# newer years sort first for the same username
+def year_cursor_key(info):
+    return info['username'], -int(info['year'])
+
+
+# "john.doe|1516" -> ("john.doe", -1516), or None without a cursor
+def parse_year_cursor(cursor):
+    if not cursor or '|' not in cursor:
+        return None
+    username, year = cursor.rsplit('|', 1)
+    return year_cursor_key({'username': username, 'year': year})
 
 
 # get all of the profiles in our database
 class SearchAllHandler(BaseHandler):
+    @tornado.gen.coroutine
     def get(self):
-        profiles = alchemy.query_all(mask_model.Profile)
-        self.write({'results': [p.base_info() for p in profiles]})
+        try:
+            listing = listing_arguments(self, mask_model.Profile.BASE_INFO_FIELDS)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({'error': str(e)})
+            return
+        if listing is None:
+            # the whole directory only gets rebuilt when a profile or user has changed since last time
+            version = yield async_alchemy.run(alchemy.query_table_versions, ['profiles', 'users'])
+            cached = caching.versioned_body('search/all', version)
+            if cached is None:
+                body = yield self.write_json_stream('results', base_info_batch, collect=True)
+                if body is not None:
+                    caching.set_versioned_body('search/all', version, body)
+            else:
+                self.write_cached_body(cached)
+        else:
+            results, cursor = yield async_alchemy.run(list_profiles, listing, mask_model.Profile.BASE_INFO_FIELDS)
+            self.write(listing_response('results', results, cursor, listing))
+
+
+# runs on the database threads, see async_alchemy and BaseHandler.write_json_stream
+def base_info_batch(after, size):
+    profiles, after = alchemy.query_batch(alchemy.people_db, mask_model.Profile, after, size)
+    return [p.base_info() for p in profiles], after
+
+
+# the paging and projection arguments SearchHandler, SearchAllHandler and MatcherHandler take
+# fields=username,photo only loads (and returns) those columns, views are only counted if they're asked for
+# limit=100 returns a page of profiles ordered by order_by (username, the default, or id) along with a cursor,
+# pass that back as cursor=... to get the next page
+# profiles without a username are left out of listings ordered by username
+# returns None without any of them, the responses are exactly what they've always been in that case
+# raises ValueError for arguments that don't make sense
+def listing_arguments(handler, allowed_fields):
+    fields = handler.get_argument('fields', None)
+    limit = handler.get_argument('limit', None)
+    cursor = handler.get_argument('cursor', None)
+    order_by = handler.get_argument('order_by', None)
+    if fields is None and limit is None and cursor is None and order_by is None:
+        return None
+    if fields is not None:
+        fields = [field for field in fields.split(',') if field]
+        for field in fields:
+            if field not in allowed_fields:
+                raise ValueError('unknown field: ' + field)
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError('limit must be a positive number')
+        limit = int(limit)
+    paged = limit is not None or cursor is not None or order_by is not None
+    if paged and order_by is None:
+        order_by = 'username'
+    if order_by not in [None, 'username', 'id']:
+        raise ValueError('order_by must be username or id')
+    if cursor is not None:
+        # "username|id" or just "id"
+        cursor = tuple(cursor.rsplit('|', 1)) if order_by == 'username' else (cursor,)
+        if order_by == 'username' and len(cursor) != 2:
+            raise ValueError('invalid cursor')
+    return {'fields': fields, 'limit': limit, 'cursor': cursor, 'order_by': order_by}
+
+
+# narrows a query on model down to the columns for fields (plus id and username for the cursor)
+# the current year's views come from Profile.view_count, the archives store them as a column
+# then orders it and cuts it down to a page, see listing_arguments
+def listing_query(query, model, fields, listing):
+    columns = [model.id.label('id'), model.username.label('username')]
+    for field in fields:
+        if field in ['id', 'username']:
+            continue
+        if field == 'views' and model is mask_model.Profile:
+            columns.append(func.coalesce(model.view_count, 0).label('views'))
+        else:
+            columns.append(getattr(model, field).label(field))
+    query = query.with_entities(*columns)
+    cursor = listing['cursor']
+    if listing['order_by'] == 'id':
+        if cursor is not None:
+            query = query.filter(model.id > cursor[0])
+        query = query.order_by(None).order_by(model.id)
+    elif listing['order_by'] == 'username':
+        query = query.filter(model.username.isnot(None))
+        if cursor is not None:
+            query = query.filter(or_(model.username > cursor[0],
+                                     and_(model.username == cursor[0], model.id > cursor[1])))
+        query = query.order_by(None).order_by(model.username, model.id)
+    if listing['limit'] is not None:
+        # one extra tells us whether there's another page
+        query = query.limit(listing['limit'] + 1)
+    return query
+
+
+def listing_key(listing):
+    if listing['order_by'] == 'id':
+        return lambda row: row.id
+    return lambda row: (row.username, row.id)
+
+
+# turns the rows from listing_query into the response, returns (results, cursor for the next page or None)
+def listing_page(rows, model, fields, listing):
+    cursor = None
+    if listing['limit'] is not None and len(rows) > listing['limit']:
+        rows = rows[:listing['limit']]
+        last = rows[-1]
+        cursor = last.id if listing['order_by'] == 'id' else last.username + '|' + last.id
+    return [model.row_to_json(row, fields) for row in rows], cursor
+
+
+def listing_response(key, results, cursor, listing):
+    response = {key: results}
+    if listing['order_by']:
+        response['cursor'] = cursor
+    return response
+
+
+# runs on the database threads, see async_alchemy
+def list_profiles(listing, default_fields):
+    fields = listing['fields'] or default_fields
+    query = listing_query(alchemy.people_db.query(mask_model.Profile), mask_model.Profile, fields, listing)
+    return listing_page(query.all(), mask_model.Profile, fields, listing)
 
 
 # get user's profile information
@@ -94,9 +407,9 @@ class ProfileHandler(BaseHandler):
     def get(self, year, username):
         # check if we're looking at the current year or going old school
         if year == tornado.options.options.current_year:
-            profile = alchemy.people_db.query(mask_model.Profile).filter_by(username=str(username)).all()
+            profile = self.people_db.query(mask_model.Profile).filter_by(username=str(username)).all()
         else:
-            profile = alchemy.archive_db.query(archives.get_archive_model(year)).filter_by(username=str(username)).all()
+            profile = self.archive_db.query(archives.get_archive_model(year)).filter_by(username=str(username)).all()
         # some quick error checking
         if len(profile) == 0:
             self.write({'error': 'no profile found'})
@@ -108,40 +421,95 @@ class ProfileHandler(BaseHandler):
             # if the user is logged in and isn't vainly looking at themselves
             # then we assume the searched for user is popular and give them a +1
             update_views(user, profile, year)
-            # self.write(profile.to_json())
-            if not user:
-                if profile.privacy == 1:
-                    self.write(profile.impers_info())
-                else:
-                    self.write(profile.no_info())
-            else:
-                if user.username == profile.username:
-                    self.write(profile.to_json())
-                else:
-                    self.write(profile.view_other())
+            self.write(profile_info(user, profile))
+
+
+# whether there are profiles to look up for the year (only archive years with an archive database)
+def profile_year(year):
+    if year == tornado.options.options.current_year:
+        return True
+    return year in archives.ARCHIVE_YEARS and alchemy.database_exists('archives')
+
+
+# how much of a profile someone gets to see
+def profile_info(user, profile):
+    if not user:
+        if profile.privacy == 1:
+            return profile.impers_info()
+        return profile.no_info()
+    if user.username == profile.username:
+        return profile.to_json()
+    return profile.view_other()
+
 
+# most usernames /profiles/batch will look up at once
+MAX_PROFILE_BATCH = 100
 
+
+# many people's profiles in one go, e.g. /profiles/batch?year=1718&usernames=john.doe,jane.anderson
+# each one is what /profile/<year>/<username> would have given the same user
+# views are only counted with track_views=1, since showing a list of people isn't the same as looking at them
+# answers {"profiles": {username: profile or {"error": ...}}}
+class ProfileBatchHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        year = self.get_argument('year', tornado.options.options.current_year)
+        usernames = [u for u in self.get_argument('usernames', '').split(',') if u]
+        track_views = self.get_argument('track_views', '0') in ['1', 'true']
+        if not profile_year(year):
+            self.set_status(400)
+            self.write({'error': 'no profiles for ' + year})
+            return
+        if len(usernames) > MAX_PROFILE_BATCH:
+            self.set_status(400)
+            self.write({'error': 'at most ' + str(MAX_PROFILE_BATCH) + ' usernames at a time'})
+            return
+        results = {}
+        if usernames:
+            results = yield async_alchemy.run(profile_batch, self.get_current_user(), year, usernames, track_views)
+        self.write({'profiles': results})
+
+
+# runs on the database threads, see async_alchemy
+def profile_batch(user, year, usernames, track_views):
+    if year == tornado.options.options.current_year:
+        model, session = mask_model.Profile, alchemy.people_db
+    else:
+        model, session = archives.get_archive_model(year), alchemy.archive_db
+    found = {}
+    for profile in session.query(model).filter(model.username.in_(usernames)):
+        found.setdefault(profile.username, []).append(profile)
+    results = {}
+    for username in usernames:
+        profiles = found.get(username, [])
+        if len(profiles) == 0:
+            results[username] = {'error': 'no profile found'}
+        elif len(profiles) > 1:
+            results[username] = {'error': 'too many profiles found'}
+        else:
+            if track_views:
+                update_views(user, profiles[0], year)
+            results[username] = profile_info(user, profiles[0])
+    return results
+
+
+# counted in memory and written out in the background along with everyone else's, see view_tracker
 def update_views(user, profile, year):
     if user and str(user.wwuid) != str(profile.wwuid) and year == tornado.options.options.current_year:
-        views = alchemy.people_db.query(mask_model.ProfileView)\
-            .filter_by(viewer=user.username, viewed=profile.username).all()
-        if len(views) == 0:
-            view = mask_model.ProfileView()
-            view.viewer = user.username
-            view.viewed = profile.username
-            view.last_viewed = datetime.datetime.now()
-            view.num_views = 1
-            alchemy.add_or_update(view)
-        else:
-            for view in views:
-                if (datetime.datetime.now() - view.last_viewed).total_seconds() > 7200:
-                    view.num_views += 1
-                    view.last_viewed = datetime.datetime.now()
-                    alchemy.add_or_update(view)
+        view_tracker.record(user.username, profile.username)
+
+
+# where the photos are served from, profiles only store the path under it
+PHOTO_URL = "https://aswwu.com/media/img-sm/"
+
+# most ids /profile_photos will look up at once
+MAX_PHOTO_BATCH = 500
 
 
 # queries the server for a user's photos
 class ProfilePhotoHandler(BaseHandler):
+    @cached_response(lambda handler, year, wwuid_or_username: year + "/" + wwuid_or_username,
+                     tags=[alchemy.PHOTOS_TAG])
     def get(self, year, wwuid_or_username):
         wwuid = None
         username = None
@@ -149,29 +517,104 @@ class ProfilePhotoHandler(BaseHandler):
             wwuid = wwuid_or_username
         else:
             username = wwuid_or_username
-        # check if we're looking at current photos or not
-        if year == self.application.options.current_year:
-            if wwuid:
-                profile = alchemy.query_by_wwuid(mask_model.Profile, wwuid)
-            else:
-                profile = alchemy.people_db.query(mask_model.Profile).filter_by(username=str(username)).all()
-        else:
-            if wwuid:
-                profile = alchemy.archive_db.query(archives.get_archive_model(year)).filter_by(wwuid=str(wwuid)).all()
-            else:
-                profile = alchemy.archive_db.query(archives.get_archive_model(year))\
-                    .filter_by(username=str(username)).all()
-        if len(profile) == 0:
-            self.write({'error': 'no profile found'})
-        elif len(profile) > 1:
+        photos = photo_map.get_map(year)
+        found = photos.lookup(wwuid, username) if photos is not None else photo_map.AMBIGUOUS
+        if found is photo_map.AMBIGUOUS or not found[0]:
+            # the map isn't ready yet, there's more than one of them, or they're newer than the map
+            found = query_photo(self.year_db(year), year, wwuid, username)
+        if found is photo_map.AMBIGUOUS:
             self.write({'error': 'too many profiles found'})
+        elif not found[0]:
+            self.write({'error': 'no profile found'})
         else:
             # now we've got just one profile, return the photo field attached to a known photo URI
-            profile = profile[0]
-            self.redirect("https://aswwu.com/media/img-sm/"+str(profile.photo))
+            self.redirect(PHOTO_URL + str(found[1]))
+
+
+# the same as PhotoMap.lookup, from the database
+def query_photo(session, year, wwuid, username):
+    # check if we're looking at current photos or not
+    model = year_maps.model_for(year)[0]
+    if wwuid:
+        photos = session.query(model.photo).filter_by(wwuid=str(wwuid)).all()
+    else:
+        photos = session.query(model.photo).filter_by(username=str(username)).all()
+    if len(photos) > 1:
+        return photo_map.AMBIGUOUS
+    if len(photos) == 0:
+        return False, None
+    return True, photos[0].photo
+
+
+# the photo URLs of many profiles at once, e.g. /profile_photos?year=1718&ids=john.doe,919428746
+# ids are wwuids or usernames like in /profile_photo, the year defaults to the current one
+# answers {"photos": {id: url}}, with null for ids that don't match exactly one profile or have no photo
+class ProfilePhotosHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        year = self.get_argument('year', tornado.options.options.current_year)
+        ids = [i for i in self.get_argument('ids', '').split(',') if i]
+        if not profile_year(year):
+            self.set_status(400)
+            self.write({'error': 'no profiles for ' + year})
+            return
+        if len(ids) > MAX_PHOTO_BATCH:
+            self.set_status(400)
+            self.write({'error': 'at most ' + str(MAX_PHOTO_BATCH) + ' ids at a time'})
+            return
+        photos = photo_map.get_map(year)
+        results = {}
+        missing = []
+        for i in ids:
+            found = photo_map.AMBIGUOUS
+            if photos is not None:
+                found = photos.lookup(*((i, None) if len(i.split(".")) == 1 else (None, i)))
+            if found is photo_map.AMBIGUOUS or not found[0]:
+                missing.append(i)
+            else:
+                results[i] = photo_url(found)
+        if missing:
+            found = yield async_alchemy.run(query_photos, year, missing)
+            results.update(found)
+        self.write({'photos': results})
+
+
+# runs on the database threads, see async_alchemy
+# the same as ProfilePhotosHandler's lookups, for the ids the photo map couldn't answer or didn't have
+def query_photos(year, ids):
+    model, session = year_maps.model_for(year)
+    wwuids = [i for i in ids if len(i.split(".")) == 1]
+    usernames = [i for i in ids if len(i.split(".")) != 1]
+    photos = photo_map.PhotoMap()
+    for key, wwuid, username, photo in session.query(model.id, model.wwuid, model.username, model.photo)\
+            .filter(or_(model.wwuid.in_(wwuids), model.username.in_(usernames))):
+        photos.add(key, wwuid, username, photo)
+    results = {}
+    for i in ids:
+        found = photos.lookup(*((i, None) if i in wwuids else (None, i)))
+        results[i] = photo_url(found) if found is not photo_map.AMBIGUOUS else None
+    return results
+
+
+# the URL for a (found, photo) lookup, None if there's no profile or it has no photo
+def photo_url(found):
+    if not found[0] or found[1] is None:
+        return None
+    return PHOTO_URL + str(found[1])
+
+
+# the profile fields their owner can change, and the ones only staff (and faculty) have
+UPDATABLE_FIELDS = ['full_name', 'photo', 'gender', 'birthday', 'email', 'phone', 'majors', 'minors', 'graduate',
+                    'preprofessional', 'class_standing', 'high_school', 'class_of', 'relationship_status',
+                    'attached_to', 'quote', 'quote_author', 'hobbies', 'career_goals', 'favorite_books',
+                    'favorite_food', 'favorite_movies', 'favorite_music', 'pet_peeves', 'personality', 'privacy',
+                    'website']
+STAFF_FIELDS = ['department', 'office', 'office_hours']
 
 
 # this updates profile information - not much to it
+# only the fields that were sent are looked at, and only the ones that actually changed are written
+# nothing is committed at all if none of them did, the response lists the ones that changed
 class ProfileUpdateHandler(BaseHandler):
     @tornado.web.authenticated
     def post(self, username):
@@ -181,52 +624,65 @@ class ProfileUpdateHandler(BaseHandler):
                 f = open('adminLog', 'w')
                 f.write(user.username + " is updating the profile of " + username + "\n")
                 f.close()
-            profile = alchemy.people_db.query(mask_model.Profile).filter_by(username=str(username)).one()
-            profile.full_name = bleach.clean(self.get_argument('full_name'))
-            profile.photo = bleach.clean(self.get_argument('photo', ''))
-            profile.gender = bleach.clean(self.get_argument('gender', ''))
-            profile.birthday = bleach.clean(self.get_argument('birthday', ''))
-            profile.email = bleach.clean(self.get_argument('email', ''))
-            profile.phone = bleach.clean(self.get_argument('phone', ''))
-            profile.majors = bleach.clean(self.get_argument('majors', ''))
-            profile.minors = bleach.clean(self.get_argument('minors', ''))
-            profile.graduate = bleach.clean(self.get_argument('graduate', ''))
-            profile.preprofessional = bleach.clean(self.get_argument('preprofessional', ''))
-            profile.class_standing = bleach.clean(self.get_argument('class_standing', ''))
-            profile.high_school = bleach.clean(self.get_argument('high_school', ''))
-            profile.class_of = bleach.clean(self.get_argument('class_of', ''))
-            profile.relationship_status = bleach.clean(self.get_argument('relationship_status', ''))
-            profile.attached_to = bleach.clean(self.get_argument('attached_to', ''))
-            profile.quote = bleach.clean(self.get_argument('quote', ''))
-            profile.quote_author = bleach.clean(self.get_argument('quote_author', ''))
-            profile.hobbies = bleach.clean(self.get_argument('hobbies', ''))
-            profile.career_goals = bleach.clean(self.get_argument('career_goals', ''))
-            profile.favorite_books = bleach.clean(self.get_argument('favorite_books', ''))
-            profile.favorite_food = bleach.clean(self.get_argument('favorite_food', ''))
-            profile.favorite_movies = bleach.clean(self.get_argument('favorite_movies', ''))
-            profile.favorite_music = bleach.clean(self.get_argument('favorite_music', ''))
-            profile.pet_peeves = bleach.clean(self.get_argument('pet_peeves', ''))
-            profile.personality = bleach.clean(self.get_argument('personality', ''))
-            profile.privacy = bleach.clean(self.get_argument('privacy', ''))
-            profile.website = bleach.clean(self.get_argument('website', ''))
+            profile = self.people_db.query(mask_model.Profile).filter_by(username=str(username)).one()
+            fields = UPDATABLE_FIELDS
             if user.status != "Student":
-                profile.department = bleach.clean(self.get_argument('department', ''))
-                profile.office = bleach.clean(self.get_argument('office', ''))
-                profile.office_hours = bleach.clean(self.get_argument('office_hours', ''))
+                fields = fields + STAFF_FIELDS
+            changed = []
+            for field in fields:
+                if field not in self.request.arguments:
+                    continue
+                value = bleach.clean(self.get_argument(field))
+                if not value_changed(getattr(profile, field), value):
+                    continue
+                setattr(profile, field, value)
+                changed.append(field)
 
-            alchemy.add_or_update(profile)
-            self.write(json.dumps('success'))
+            if changed:
+                alchemy.add_or_update(profile, self.people_db)
+                if 'full_name' in changed or 'photo' in changed:
+                    revocations.revoke(profile.wwuid)
+                    name_index.update_profile(profile)
+                    photo_map.update_profile(profile)
+            self.write({'status': 'success', 'changed': changed})
         else:
             self.write({'error': 'invalid permissions'})
 
 
+# whether a submitted (cleaned) value is different from what the profile has
+# e.g. privacy is stored as a number but always submitted as a string
+def value_changed(current, value):
+    if current is None:
+        return True
+    if isinstance(current, six.string_types):
+        return current != value
+    return six.text_type(current) != value
+
+
 class MatcherHandler(BaseHandler):
     @tornado.web.authenticated
+    @tornado.gen.coroutine
     def get(self):
         user = self.current_user
 
         if 'matcher' in user.roles:
-            profiles = alchemy.query_all(mask_model.Profile)
-            self.write({'database': [p.view_other() for p in profiles]})
+            try:
+                listing = listing_arguments(self, mask_model.Profile.VIEW_OTHER_FIELDS)
+            except ValueError as e:
+                self.set_status(400)
+                self.write({'error': str(e)})
+                return
+            if listing is None:
+                yield self.write_json_stream('database', view_other_batch)
+            else:
+                profiles, cursor = yield async_alchemy.run(list_profiles, listing,
+                                                           mask_model.Profile.VIEW_OTHER_FIELDS)
+                self.write(listing_response('database', profiles, cursor, listing))
         else:
             self.write("{'error': 'Insufficient Permissions :('}")
+
+
+# runs on the database threads, see async_alchemy and BaseHandler.write_json_stream
+def view_other_batch(after, size):
+    profiles, after = alchemy.query_batch(alchemy.people_db, mask_model.Profile, after, size)
+    return [p.view_other() for p in profiles], after
@@ -14,7 +14,7 @@ class PagesHandler(BaseHandler):
     def get(self):
         page_id = '12345'
         try:
-            page = alchemy.query_by_page_id(pages_model.Page, page_id)
+            page = alchemy.query_by_page_id(pages_model.Page, page_id, self.page_db)
             if len(page) == 0:
                 self.write({'error': 'no page found'})
             elif len(page) > 1:
@@ -32,7 +32,7 @@ class PagesUpdateHandler(BaseHandler):
     def post(self, page_id):
         try:
             user = self.current_user
-            page = alchemy.query_by_page_id(pages_model.Page, page_id)
+            page = alchemy.query_by_page_id(pages_model.Page, page_id, self.page_db)
             editors = []
             for temp_dict in page[0].serialize()['editors']:
                 temp = temp_dict['name']
@@ -53,7 +53,7 @@ class PagesUpdateHandler(BaseHandler):
                     page[0].tags = bleach.clean(self.get_argument('tags'))
                     page[0].category = bleach.clean(self.get_argument('category'))
                     page[0].theme_blob = bleach.clean(self.get_argument('theme_blob'))
-                alchemy.add_or_update_page(page[0])
+                alchemy.add_or_update_page(page[0], self.page_db)
 
         except Exception as e:
             logger.error("PagesUpdateHandler: error.\n" + str(e.message))
@@ -0,0 +1,102 @@
+import datetime
+import logging
+
+import tornado.gen
+import tornado.web
+from sqlalchemy import func
+
+from src.aswwu.base_handlers import BaseHandler
+import src.aswwu.models.mask as mask_model
+import src.aswwu.alchemy as alchemy
+import src.aswwu.async_alchemy as async_alchemy
+
+logger = logging.getLogger("aswwu")
+
+# the most hours/days a stat can cover, and the most profiles /views/top will list
+MAX_HOURS = 24 * 14
+MAX_DAYS = 366
+MAX_TOP = 100
+
+
+# the profiles viewed the most over the last `hours` or `days` (7 days by default), administrators only
+# e.g. /views/top?days=7&limit=10
+class TopViewedHandler(BaseHandler):
+    @tornado.web.authenticated
+    @tornado.gen.coroutine
+    def get(self):
+        if 'administrator' not in self.current_user.roles:
+            self.set_status(401)
+            self.write({'error': 'insufficient permissions'})
+            return
+        try:
+            period = period_arguments(self, 7)
+            limit = self.get_argument('limit', '10')
+            if not limit.isdigit() or not 1 <= int(limit) <= MAX_TOP:
+                raise ValueError('limit must be between 1 and ' + str(MAX_TOP))
+        except ValueError as e:
+            self.set_status(400)
+            self.write({'error': str(e)})
+            return
+        results = yield async_alchemy.run(top_viewed, period, int(limit))
+        self.write({'results': results})
+
+
+# a profile's views per hour or day over the last `hours` or `days` (30 days by default)
+# for the profile's owner and administrators, e.g. /views/trend/john.doe?hours=48
+class ViewTrendHandler(BaseHandler):
+    @tornado.web.authenticated
+    @tornado.gen.coroutine
+    def get(self, username):
+        user = self.current_user
+        if user.username != username and 'administrator' not in user.roles:
+            self.set_status(401)
+            self.write({'error': 'insufficient permissions'})
+            return
+        try:
+            period = period_arguments(self, 30)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({'error': str(e)})
+            return
+        trend = yield async_alchemy.run(view_trend, username, period)
+        self.write({'username': username, 'total': sum(bucket['views'] for bucket in trend), 'trend': trend})
+
+
+# the ?hours= or ?days= of a request as (rollup model, bucket column name, the buckets covered oldest first)
+# raises ValueError if they don't make sense
+def period_arguments(handler, default_days):
+    hours = handler.get_argument('hours', None)
+    days = handler.get_argument('days', None)
+    if hours is not None and days is not None:
+        raise ValueError('pass hours or days, not both')
+    now = datetime.datetime.now()
+    if hours is not None:
+        if not hours.isdigit() or not 1 <= int(hours) <= MAX_HOURS:
+            raise ValueError('hours must be between 1 and ' + str(MAX_HOURS))
+        last = now.replace(minute=0, second=0, microsecond=0)
+        return mask_model.ProfileViewHour, 'hour', \
+            [last - datetime.timedelta(hours=i) for i in reversed(range(int(hours)))]
+    if days is None:
+        days = str(default_days)
+    if not days.isdigit() or not 1 <= int(days) <= MAX_DAYS:
+        raise ValueError('days must be between 1 and ' + str(MAX_DAYS))
+    return mask_model.ProfileViewDay, 'day', [now.date() - datetime.timedelta(days=i) for i in reversed(range(int(days)))]
+
+
+# runs on the database threads, see async_alchemy
+def top_viewed(period, limit):
+    model, bucket, buckets = period
+    views = func.sum(model.views).label('views')
+    rows = alchemy.people_db.query(model.viewed, views).filter(getattr(model, bucket) >= buckets[0])\
+        .group_by(model.viewed).order_by(views.desc(), model.viewed).limit(limit).all()
+    return [{'username': viewed, 'views': int(total)} for viewed, total in rows]
+
+
+# runs on the database threads, see async_alchemy
+# every bucket in the period is there, the ones without views as 0
+def view_trend(username, period):
+    model, bucket, buckets = period
+    column = getattr(model, bucket)
+    counts = dict(alchemy.people_db.query(column, model.views)
+                  .filter(model.viewed == username, column >= buckets[0]).all())
+    return [{bucket: str(start), 'views': counts.get(start, 0)} for start in buckets]
@@ -5,6 +5,7 @@ from settings import keys
 
 import src.aswwu.models.mask as mask_model
 import src.aswwu.alchemy as alchemy
+import src.aswwu.revocations as revocations
 
 logger = logging.getLogger("aswwu")
 
@@ -18,11 +19,12 @@ class SamlHandler(BaseHandler):
                 full_name = self.get_argument('full_name', None)
                 email_address = self.get_argument('email_address', None)
                 if employee_id:
-                    user = alchemy.query_user(employee_id)
+                    user = alchemy.query_user(employee_id, self.people_db)
                     if not user:
                         user = mask_model.User(wwuid=employee_id, username=email_address.split('@', 1)[0],
                                                full_name=full_name, status='Student')
-                        alchemy.add_or_update(user)
+                        alchemy.add_or_update(user, self.people_db)
+                        revocations.revoke(employee_id)
                     self.write({'status': 'success'})
                 else:
                     logger.info("AccountHandler: error")
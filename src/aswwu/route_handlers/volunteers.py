@@ -7,6 +7,7 @@ from src.aswwu.base_handlers import BaseHandler
 import src.aswwu.models.mask as mask_model
 import src.aswwu.models.volunteers as volunteer_model
 import src.aswwu.alchemy as alchemy
+import src.aswwu.revocations as revocations
 
 logger = logging.getLogger("aswwu")
 
@@ -17,10 +18,10 @@ class VolunteerHandler(BaseHandler):
     def get(self, wwuid):
         user = self.current_user
         if user.wwuid == wwuid or 'volunteer' in user.roles:
-            volunteer = alchemy.query_by_wwuid(volunteer_model.Volunteer, wwuid)
+            volunteer = alchemy.query_by_wwuid(volunteer_model.Volunteer, wwuid, self.people_db)
             if len(volunteer) == 0:
                 volunteer = volunteer_model.Volunteer(wwuid=user.wwuid)
-                volunteer = alchemy.add_or_update(volunteer)
+                volunteer = alchemy.add_or_update(volunteer, self.people_db)
             else:
                 volunteer = volunteer[0]
             self.write(volunteer.to_json())
@@ -30,12 +31,12 @@ class VolunteerHandler(BaseHandler):
     @tornado.web.authenticated
     def post(self):
         user = self.current_user
-        volunteer = alchemy.query_by_wwuid(volunteer_model.Volunteer, user.wwuid)[0]
+        volunteer = alchemy.query_by_wwuid(volunteer_model.Volunteer, user.wwuid, self.people_db)[0]
         for role in self.request.arguments:
             if hasattr(volunteer, role):
                 volunteer.setattr(role, self.get_argument(role, '') == '1')
         logger.debug(volunteer.only_true())
-        alchemy.add_or_update(volunteer)
+        alchemy.add_or_update(volunteer, self.people_db)
         self.write(json.dumps('success'))
 
 
@@ -54,7 +55,7 @@ class VolunteerRoleHandler(BaseHandler):
                 # let volunteer admins grant permissions for other volutneer admins
                 username = self.get_argument('username', '').replace(' ', '.').lower()
                 # .ilike is for case insesitive.
-                fuser = alchemy.people_db.query(mask_model.User).filter(mask_model.User.username.ilike(username)).all()
+                fuser = self.people_db.query(mask_model.User).filter(mask_model.User.username.ilike(username)).all()
                 if not fuser:
                     self.write({'error': 'user does not exist'})
                 else:
@@ -65,11 +66,12 @@ class VolunteerRoleHandler(BaseHandler):
                     roles.append('volunteer')
                     roles = set(roles)
                     fuser.roles = ','.join(roles)
-                    alchemy.add_or_update(fuser)
+                    alchemy.add_or_update(fuser, self.people_db)
+                    revocations.revoke(fuser.wwuid)
                     self.write({'response': 'success'})
             elif cmd == 'search' or cmd == 'viewPrintOut':
                 # searcheth away!
-                volunteers = alchemy.people_db.query(volunteer_model.Volunteer)
+                volunteers = self.people_db.query(volunteer_model.Volunteer)
                 args = {}
                 for role in self.request.arguments:
                     if hasattr(volunteer_model.Volunteer, role) and\
@@ -89,7 +91,7 @@ class VolunteerRoleHandler(BaseHandler):
                 # vusers = [{'profile': query_by_wwuid(Profile, v.wwuid)[0], 'volunteer_data': v} for v in volunteers]
                 vusers = []
                 for v in volunteers:
-                    vol_result = alchemy.query_by_wwuid(mask_model.Profile, v.wwuid)
+                    vol_result = alchemy.query_by_wwuid(mask_model.Profile, v.wwuid, self.people_db)
                     if len(vol_result) > 0:
                         vusers.append({'profile': vol_result[0], 'volunteer_data': v})
                 # should we return the results as JSON
@@ -0,0 +1,107 @@
+# search_index.py
+
+# SQLite FTS5 full text indexes over the searchable profile columns
+# the current year's index (profiles_search) is kept in sync by triggers on the profiles table
+# each archive year gets its own index (e.g. profiles1617_search), built once since the archives never change
+# `python migrate.py` creates and rebuilds all of them
+# the indexes point at rowids, and since the profile tables' primary keys are uuid strings rather than an
+# INTEGER PRIMARY KEY, a VACUUM is free to renumber those rowids and leave the indexes pointing at the wrong rows
+# so only ever VACUUM through `python migrate.py --vacuum`, which rebuilds them straight afterwards
+
+import logging
+import re
+import threading
+
+from sqlalchemy import column, literal_column, table, text
+
+logger = logging.getLogger("aswwu")
+
+# the columns worth searching through, contact info and the like is left out on purpose
+COLUMNS = ['username', 'full_name', 'majors', 'minors', 'graduate', 'preprofessional', 'class_standing',
+           'high_school', 'class_of', 'hobbies', 'career_goals', 'favorite_books', 'favorite_food',
+           'favorite_movies', 'favorite_music', 'pet_peeves', 'personality', 'department', 'office']
+
+
+def index_name(table_name):
+    return table_name + "_search"
+
+
+# creates the index (and for tables that change, the triggers keeping it in sync) then fills it from scratch
+# only the COLUMNS the table actually has are indexed, some of the older archives are missing a few
+def create_index(connection, table_name, triggers=True):
+    index = index_name(table_name)
+    existing = [row[1] for row in connection.execute("PRAGMA table_info(" + table_name + ")")]
+    indexed = [c for c in COLUMNS if c in existing]
+    columns = ", ".join(indexed)
+    new_columns = ", ".join("new." + c for c in indexed)
+    old_columns = ", ".join("old." + c for c in indexed)
+    connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS " + index + " USING fts5(" + columns +
+                       ", content='" + table_name + "', content_rowid='rowid')")
+    if triggers:
+        connection.execute("CREATE TRIGGER IF NOT EXISTS " + index + "_insert AFTER INSERT ON " + table_name +
+                           " BEGIN INSERT INTO " + index + "(rowid, " + columns + ") VALUES (new.rowid, " +
+                           new_columns + "); END")
+        connection.execute("CREATE TRIGGER IF NOT EXISTS " + index + "_delete AFTER DELETE ON " + table_name +
+                           " BEGIN INSERT INTO " + index + "(" + index + ", rowid, " + columns +
+                           ") VALUES ('delete', old.rowid, " + old_columns + "); END")
+        # only changes to the indexed columns matter, e.g. not every new view_count
+        # (dropped first in case it was created back when it watched every column)
+        connection.execute("DROP TRIGGER IF EXISTS " + index + "_update")
+        connection.execute("CREATE TRIGGER " + index + "_update AFTER UPDATE OF " + columns + " ON " + table_name +
+                           " BEGIN INSERT INTO " + index + "(" + index + ", rowid, " + columns +
+                           ") VALUES ('delete', old.rowid, " + old_columns + "); INSERT INTO " + index +
+                           "(rowid, " + columns + ") VALUES (new.rowid, " + new_columns + "); END")
+    connection.execute("INSERT INTO " + index + "(" + index + ") VALUES ('rebuild')")
+
+
+# the columns each table's index covers, looked up once per table (empty if it has no index)
+# an index created while the server is running is picked up after a restart
+_indexed_columns = {}
+_indexed_columns_lock = threading.Lock()
+
+
+def indexed_columns(session, table_name):
+    with _indexed_columns_lock:
+        if table_name not in _indexed_columns:
+            try:
+                _indexed_columns[table_name] = [row[1] for row in session.execute(
+                    text("PRAGMA table_info(" + index_name(table_name) + ")"))]
+            except Exception as e:
+                logger.info(e)
+                _indexed_columns[table_name] = []
+        return _indexed_columns[table_name]
+
+
+# turns free text into FTS5 prefix terms, e.g. "john do" -> '"john"* "do"*'
+# returns None if there's nothing to search for
+def _prefix_terms(value):
+    words = re.findall(r"\w+", value, re.UNICODE)
+    if not words:
+        return None
+    return " ".join('"' + word + '"*' for word in words)
+
+
+# a search term without a field: every word has to start a word in the username or full name
+def name_match(value):
+    terms = _prefix_terms(value)
+    if terms is None:
+        return None
+    return "{username full_name} : (" + terms + ")"
+
+
+# field=value,other value: the column has to contain one of the values
+def column_match(field, values):
+    phrases = [_prefix_terms(value) for value in values]
+    phrases = ["(" + phrase + ")" for phrase in phrases if phrase]
+    if not phrases:
+        return None
+    return "{" + field + "} : (" + " OR ".join(phrases) + ")"
+
+
+# limits a query on a profiles (or archive) model to rows matching every expression, best matches first
+def apply(query, model, expressions):
+    index = table(index_name(model.__tablename__), column("rowid"), column("rank"),
+                  column(index_name(model.__tablename__)))
+    return query.join(index, index.c.rowid == literal_column(model.__tablename__ + ".rowid"))\
+        .filter(index.c[index_name(model.__tablename__)].op("MATCH")(" AND ".join(expressions)))\
+        .order_by(index.c.rank)
@@ -0,0 +1,172 @@
+# view_tracker.py
+
+# profile views are counted in memory and written out every view_flush_interval seconds, all in one transaction
+# so looking at a profile never has to wait on a write (or an fsync) of its own
+# a viewer only counts once per profile every VIEW_WINDOW seconds, checked here first and again against
+# the database's last_viewed when the views are written, which covers views counted by other processes
+# each counted view is also logged as a ProfileViewEvent and added to the hourly and daily rollups in the same commit
+# whatever hasn't been written yet is written when the server shuts down (see application.py)
+
+import datetime
+import logging
+import threading
+import time
+
+import tornado.ioloop
+from sqlalchemy import and_, bindparam
+from tornado.options import define, options
+
+import src.aswwu.alchemy as alchemy
+import src.aswwu.async_alchemy as async_alchemy
+import src.aswwu.models.mask as mask_model
+from src.aswwu.models.bases import uuid_gen
+
+logger = logging.getLogger("aswwu")
+
+define("view_flush_interval", default=5, help="seconds between writes of the profile views counted in memory")
+
+# seconds before the same viewer counts as viewing the same profile again
+VIEW_WINDOW = 7200
+# (viewer, viewed) pairs looked up per query, SQLite limits how many parameters a query can have
+FLUSH_CHUNK_SIZE = 400
+# most (viewer, viewed) pairs kept waiting after failed writes, past that the views that failed are dropped
+MAX_PENDING = 50000
+
+# (viewer, viewed) -> when this process last counted it, for the ones still inside the window
+_last_counted = {}
+# (viewer, viewed) -> when each of the views not written yet happened, oldest first
+_pending = {}
+_lock = threading.Lock()
+
+
+# call this for every logged in view of someone else's current profile
+def record(viewer, viewed):
+    now = time.time()
+    key = (viewer, viewed)
+    with _lock:
+        last = _last_counted.get(key)
+        if last is not None and now - last <= VIEW_WINDOW:
+            return
+        _last_counted[key] = now
+        _pending.setdefault(key, []).append(now)
+
+
+# views that couldn't be written go back to wait for the next try, as long as there's room (see MAX_PENDING)
+def _restore(views):
+    dropped = 0
+    with _lock:
+        for key, times in views.items():
+            if key not in _pending and len(_pending) >= MAX_PENDING:
+                dropped += len(times)
+                continue
+            _pending[key] = sorted(times + _pending.get(key, []))
+    if dropped:
+        logger.info("view_tracker: dropped " + str(dropped) + " views that couldn't be written")
+
+
+def _chunks(things):
+    things = list(things)
+    return [things[i:i + FLUSH_CHUNK_SIZE] for i in range(0, len(things), FLUSH_CHUNK_SIZE)]
+
+
+# writes everything counted so far in a single commit
+# runs on the database threads (see start()), or directly once the IOLoop has stopped
+def flush():
+    global _pending
+    now = time.time()
+    with _lock:
+        views, _pending = _pending, {}
+        for key, last in _last_counted.items():
+            if now - last > VIEW_WINDOW:
+                del _last_counted[key]
+    if not views:
+        return
+    try:
+        existing = {}
+        for keys in _chunks(views):
+            viewers = set(viewer for viewer, viewed in keys)
+            vieweds = set(viewed for viewer, viewed in keys)
+            for view in alchemy.people_db.query(mask_model.ProfileView)\
+                    .filter(mask_model.ProfileView.viewer.in_(viewers), mask_model.ProfileView.viewed.in_(vieweds)):
+                existing.setdefault((view.viewer, view.viewed), view)
+        added = {}
+        events = []
+        for key, times in views.items():
+            view = existing.get(key)
+            if view is None:
+                view = mask_model.ProfileView(viewer=key[0], viewed=key[1], num_views=0)
+                alchemy.people_db.add(view)
+            elif view.last_viewed is not None and \
+                    time.mktime(view.last_viewed.timetuple()) >= times[0] - VIEW_WINDOW:
+                # another process counted them inside the window already
+                times = times[1:]
+            if times:
+                view.num_views = (view.num_views or 0) + len(times)
+                view.last_viewed = datetime.datetime.fromtimestamp(times[-1])
+                added[key[1]] = added.get(key[1], 0) + len(times)
+                events += [(key[0], key[1], datetime.datetime.fromtimestamp(t)) for t in times]
+        if events:
+            add_events(events)
+        for usernames in _chunks(added):
+            for profile in alchemy.people_db.query(mask_model.Profile)\
+                    .filter(mask_model.Profile.username.in_(usernames)):
+                # counted in SQL so other processes' flushes can't overwrite ours
+                profile.view_count = mask_model.Profile.view_count + added[profile.username]
+        alchemy.people_db.commit()
+    except Exception as e:
+        logger.info("view_tracker: couldn't write " + str(len(views)) + " views: " + str(e))
+        alchemy.people_db.rollback()
+        _restore(views)
+
+
+# logs the views and adds them to the rollups, in the caller's transaction
+# events are (viewer, viewed, viewed_at)
+def add_events(events):
+    alchemy.people_db.execute(mask_model.ProfileViewEvent.__table__.insert(),
+                              [{'id': uuid_gen(), 'viewer': viewer, 'viewed': viewed, 'viewed_at': viewed_at}
+                               for viewer, viewed, viewed_at in events],
+                              bind=alchemy.people_db().write_bind())
+    hours = {}
+    days = {}
+    for viewer, viewed, viewed_at in events:
+        hour = (viewed, viewed_at.replace(minute=0, second=0, microsecond=0))
+        hours[hour] = hours.get(hour, 0) + 1
+        day = (viewed, viewed_at.date())
+        days[day] = days.get(day, 0) + 1
+    _add_to_rollup(mask_model.ProfileViewHour.__table__, 'hour', hours)
+    _add_to_rollup(mask_model.ProfileViewDay.__table__, 'day', days)
+
+
+# counts is {(viewed, bucket): views}, rows that don't exist yet are created first
+def _add_to_rollup(rollup, bucket, counts):
+    bind = alchemy.people_db().write_bind()
+    alchemy.people_db.execute(rollup.insert().prefix_with("OR IGNORE"),
+                              [{'id': uuid_gen(), 'viewed': viewed, bucket: start, 'views': 0}
+                               for viewed, start in counts], bind=bind)
+    alchemy.people_db.execute(rollup.update().where(and_(rollup.c.viewed == bindparam('b_viewed'),
+                                                         rollup.c[bucket] == bindparam('b_start')))
+                              .values(views=rollup.c.views + bindparam('b_views')),
+                              [{'b_viewed': viewed, 'b_start': start, 'b_views': views}
+                               for (viewed, start), views in counts.items()], bind=bind)
+
+
+_flusher = None
+
+
+# call it from the IOLoop, in each process that serves requests
+def start():
+    global _flusher
+    if _flusher is not None:
+        _flusher.stop()
+    _flusher = tornado.ioloop.PeriodicCallback(lambda: async_alchemy.run(flush), options.view_flush_interval * 1000)
+    _flusher.start()
+
+
+# writes what's left, call it once the IOLoop has stopped
+def stop():
+    global _flusher
+    if _flusher is not None:
+        _flusher.stop()
+        _flusher = None
+    flush()
+    alchemy.remove_sessions()
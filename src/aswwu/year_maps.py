@@ -0,0 +1,112 @@
+# year_maps.py
+
+# the bookkeeping photo_map.py and name_index.py share: something built from every profile, one per year
+# built in the background when the server starts, requests fall back to SQL until a year's is ready
+# the current year's is kept fresh by update_profile() in this process, and rebuilt when its tag's version
+# (see alchemy.PROFILE_TAGS) shows another process has changed a profile in a way that matters to it
+
+import logging
+import threading
+
+import tornado.ioloop
+from tornado.options import options
+
+import src.aswwu.alchemy as alchemy
+import src.aswwu.archive_models as archives
+import src.aswwu.async_alchemy as async_alchemy
+import src.aswwu.caching as caching
+import src.aswwu.models.mask as mask_model
+
+logger = logging.getLogger("aswwu")
+
+
+# the model a year's profiles are in, and the (scoped) session to read them with
+def model_for(year):
+    if year == options.current_year:
+        return mask_model.Profile, alchemy.people_db
+    return archives.get_archive_model(year), alchemy.archive_db
+
+
+# name is what the log calls them and tag is the tableversions row to watch
+# new() makes an empty one, fill(built, model, session) adds a year's profiles to it
+# and update(built, profile) puts in a profile that has just been created or changed
+class YearMaps:
+    def __init__(self, name, tag, new, fill, update):
+        self.name = name
+        self.tag = tag
+        self.new = new
+        self.fill = fill
+        self.update = update
+        # year -> map, only once it has been completely built
+        self.maps = {}
+        # year -> map that's in the middle of being built, changes go to both
+        self.building = {}
+        self.lock = threading.Lock()
+        # the current year's tag version as of its last build
+        self.version = None
+        self.poller = None
+
+    def get(self, year):
+        return self.maps.get(year)
+
+    # (re)builds a year's map from the database and swaps it in once it's done
+    # fill() has to leave profiles that are already there alone, they came from update_profile() and are newer
+    def build(self, year):
+        new_map = self.new()
+        with self.lock:
+            self.building[year] = new_map
+        try:
+            # read before the profiles are, so anything written during the build gets it rebuilt again
+            version = alchemy.query_table_versions([self.tag]) if year == options.current_year else None
+            model, session = model_for(year)
+            self.fill(new_map, model, session)
+            with self.lock:
+                self.maps[year] = new_map
+                if version is not None:
+                    self.version = version
+            logger.info(self.name + ": built " + year + " from " + str(len(new_map)) + " profiles")
+        except Exception as e:
+            logger.info(self.name + ": couldn't build " + year + ": " + str(e))
+        finally:
+            with self.lock:
+                self.building.pop(year, None)
+
+    def build_all(self):
+        years = [options.current_year]
+        if alchemy.database_exists('archives'):
+            years += archives.ARCHIVE_YEARS
+        for year in years:
+            self.build(year)
+            alchemy.remove_sessions()
+
+    # rebuilds the current year's map if another process has changed it since it was built
+    # and drops the responses built from the old one (see caching.cached_response)
+    # runs on the database threads, see start()
+    def refresh(self):
+        year = options.current_year
+        with self.lock:
+            if year in self.building or year not in self.maps:
+                return
+        if alchemy.query_table_versions([self.tag]) not in (None, self.version):
+            self.build(year)
+            caching.invalidate_tags([self.tag])
+        alchemy.remove_sessions()
+
+    # builds every year's map on the database threads, then checks for changes every poll_interval seconds
+    # call it from the IOLoop, in each process that serves requests
+    def start(self, poll_interval):
+        async_alchemy.run(self.build_all)
+        if self.poller is not None:
+            self.poller.stop()
+        if poll_interval > 0:
+            self.poller = tornado.ioloop.PeriodicCallback(lambda: async_alchemy.run(self.refresh),
+                                                          poll_interval * 1000)
+            self.poller.start()
+
+    # call this whenever a current year profile is created or changed
+    def update_profile(self, profile):
+        with self.lock:
+            targets = [built for built in (self.maps.get(options.current_year),
+                                           self.building.get(options.current_year)) if built is not None]
+        for built in targets:
+            self.update(built, profile)
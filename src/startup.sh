@@ -1,4 +1 @@
-sudo screen -dSm ps1 python server.py --port=8881
-sudo screen -dSm ps2 python server.py --port=8882
-sudo screen -dSm ps3 python server.py --port=8883
-sudo screen -dSm ps4 python server.py --port=8884
+sudo screen -dSm aswwu python server.py --production --port=8888
@@ -1,6 +1,12 @@
 # test_system.py
 import requests
 import json
+import time
+
+import src.aswwu.archive_models as archives
+import src.aswwu.caching as caching
+import src.aswwu.photo_map as photo_map
+import src.aswwu.revocations as revocations
 
 
 def test_root(testing_server):
@@ -64,3 +70,154 @@ def test_search_all(testing_server):
     resp = requests.get(url)
     assert (resp.status_code == 200)
     assert (json.loads(resp.text) == expected_data)
+
+
+def test_search(testing_server):
+    expected_data = {
+        "results": [{
+            "username": "john.doe",
+            "photo": "profiles/1718/00958-2019687.jpg",
+            "email": "",
+            "full_name": "John Doe",
+            "views": "6"
+        }]
+    }
+
+    url = 'http://127.0.0.1:8888/search/1718/john do'
+    resp = requests.get(url)
+    assert (resp.status_code == 200)
+    assert (json.loads(resp.text) == expected_data)
+
+    url = 'http://127.0.0.1:8888/search/1718/gender=male;doe'
+    resp = requests.get(url)
+    assert (resp.status_code == 200)
+    assert (json.loads(resp.text) == expected_data)
+
+
+def test_search_all_years(testing_server):
+    url = 'http://127.0.0.1:8888/search/all-years/an?limit=2'
+    resp = requests.get(url)
+    assert (resp.status_code == 200)
+    data = json.loads(resp.text)
+    assert ([(r['username'], r['year']) for r in data['results']] == [("jane.anderson", "1718"),
+                                                                       ("ryan.rabello", "1718")])
+    assert (data['cursor'] == "ryan.rabello|1718")
+
+    resp = requests.get(url + '&cursor=' + data['cursor'])
+    assert (resp.status_code == 200)
+    data = json.loads(resp.text)
+    assert ([r['username'] for r in data['results']] == ["susan.brown"])
+    assert (data['cursor'] is None)
+
+    for limit in ['0', '-1', 'two']:
+        resp = requests.get('http://127.0.0.1:8888/search/all-years/an', params={'limit': limit})
+        assert (resp.status_code == 400)
+
+
+def test_search_all_paging(testing_server):
+    url = 'http://127.0.0.1:8888/search/all?limit=4&fields=username,views'
+    resp = requests.get(url)
+    assert (resp.status_code == 200)
+    data = json.loads(resp.text)
+    assert (data['results'] == [{"username": "jane.anderson", "views": "8"},
+                                {"username": "john.doe", "views": "6"},
+                                {"username": "mary.johnson", "views": "6"},
+                                {"username": "michael.scott", "views": "0"}])
+
+    resp = requests.get(url, params={'cursor': data['cursor']})
+    assert (resp.status_code == 200)
+    data = json.loads(resp.text)
+    assert (data['results'] == [{"username": "ryan.rabello", "views": "9"},
+                                {"username": "susan.brown", "views": "18"}])
+    assert (data['cursor'] is None)
+
+
+def test_search_all_etag(testing_server):
+    url = 'http://127.0.0.1:8888/search/all'
+    resp = requests.get(url, headers={'Accept-Encoding': 'identity'})
+    assert (resp.status_code == 200)
+    etag = resp.headers['Etag']
+
+    resp = requests.get(url, headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+    assert (resp.status_code == 304)
+
+    resp = requests.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert (resp.status_code == 200)
+    assert (resp.headers['Content-Encoding'] == 'gzip')
+    assert (resp.headers['Etag'] != etag)
+
+
+def test_profile_photo_cached(testing_server):
+    url = 'http://127.0.0.1:8888/profile_photo/1718/ryan.rabello'
+    expected = 'https://aswwu.com/media/img-sm/profiles/1718/00958-2019687.jpg'
+    # the second one comes out of the response cache
+    for _ in range(2):
+        resp = requests.get(url, allow_redirects=False)
+        assert (resp.status_code == 302)
+        assert (resp.headers['Location'] == expected)
+
+
+def test_view_stats(testing_server):
+    resp = requests.get('http://127.0.0.1:8888/views/trend/ryan.rabello', params={'days': '3'})
+    assert (resp.status_code == 200)
+    data = json.loads(resp.text)
+    assert (len(data['trend']) == 3)
+    assert (data['total'] == sum(bucket['views'] for bucket in data['trend']))
+
+    # other people's trends and the top list are for administrators
+    resp = requests.get('http://127.0.0.1:8888/views/trend/john.doe')
+    assert (resp.status_code == 401)
+    resp = requests.get('http://127.0.0.1:8888/views/top')
+    assert (resp.status_code == 401)
+
+
+def test_profile_photos(testing_server):
+    url = 'http://127.0.0.1:8888/profile_photos'
+    resp = requests.get(url, params={'ids': 'ryan.rabello,919428746,nobody.here'})
+    assert (resp.status_code == 200)
+    photo = 'https://aswwu.com/media/img-sm/profiles/1718/00958-2019687.jpg'
+    assert (json.loads(resp.text) == {'photos': {'ryan.rabello': photo, '919428746': photo, 'nobody.here': None}})
+
+
+def test_photo_map_archive_wwuids():
+    # archived profiles have integer wwuids, the redirects look them up by the text in the URL
+    model = archives.get_archive_model("1617")
+    profile = model(id=1, wwuid=919428746, username='ryan.rabello', photo='profiles/1617/00958-2019687.jpg')
+    photos = photo_map.PhotoMap()
+    photos.add(profile.id, profile.wwuid, profile.username, profile.photo)
+    assert (photos.lookup('919428746') == (True, 'profiles/1617/00958-2019687.jpg'))
+    assert (photos.lookup(919428746) == (True, 'profiles/1617/00958-2019687.jpg'))
+    assert (photos.lookup(username='ryan.rabello') == (True, 'profiles/1617/00958-2019687.jpg'))
+    assert (photos.lookup('919428747') == (False, None))
+
+
+def test_profiles_batch(testing_server):
+    url = 'http://127.0.0.1:8888/profiles/batch'
+    resp = requests.get(url, params={'usernames': 'ryan.rabello,nobody.here'})
+    assert (resp.status_code == 200)
+    profiles = json.loads(resp.text)['profiles']
+    single = json.loads(requests.get('http://127.0.0.1:8888/profile/1718/ryan.rabello').text)
+    assert (profiles['ryan.rabello'] == single)
+    assert (profiles['nobody.here'] == {'error': 'no profile found'})
+
+
+def test_profile_update_unchanged(testing_server):
+    profile = json.loads(requests.get('http://127.0.0.1:8888/profile/1718/ryan.rabello').text)
+    # sending back what's already there changes (and writes) nothing
+    resp = requests.post('http://127.0.0.1:8888/update/ryan.rabello', data={'full_name': profile['full_name']})
+    assert (resp.status_code == 200)
+    assert (json.loads(resp.text) == {'status': 'success', 'changed': []})
+
+
+def test_revocations_poll(peopledb_conn):
+    # a revocation another process wrote, this one only hears about it from the table
+    revoked_at = time.time()
+    peopledb_conn.execute("INSERT OR REPLACE INTO revocations (id, wwuid, revoked_at) VALUES (?, ?, ?)",
+                          'test-revocation', '1234567', revoked_at)
+    try:
+        assert (not caching.claims_revoked('1234567', revoked_at - 1))
+        revocations.poll()
+        assert (caching.claims_revoked('1234567', revoked_at - 1))
+        assert (not caching.claims_revoked('1234567', revoked_at + 1))
+    finally:
+        peopledb_conn.execute("DELETE FROM revocations WHERE id = 'test-revocation'")